@@ -1,51 +1,138 @@
 import requests
 import time
+from urllib.parse import urlencode
+
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS, body_size
+from rate_limiter import RateLimiter, backoff_delay
+
+# Bitrix24 отдает списки страницами по 50 записей, а в один batch помещается до 50 команд
+PAGE_SIZE = 50
+BATCH_MAX_COMMANDS = 50
+# При превышении лимита портал отвечает 503 с ошибкой QUERY_LIMIT_EXCEEDED
+THROTTLE_STATUSES = (429, 503)
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Сессия requests с пулом keep-alive соединений"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _flatten_params(params, prefix: str = None) -> list:
+    """Разворачивает вложенные dict/list в пары ключ-значение в формате PHP (filter[>=ID]=1, select[0]=ID)"""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        if value is None:
+            continue
+        name = f'{prefix}[{key}]' if prefix is not None else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            pairs.extend(_flatten_params(value, name))
+        else:
+            pairs.append((name, value))
+    return pairs
+
+
+def _collect_batch_result(results: dict, pending: dict, batch_result: dict) -> dict:
+    """Складывает результаты batch в results и возвращает команды, которые нужно повторить из-за лимита"""
+    # Пустые словари PHP отдает как [], поэтому приводим через `or {}`
+    results.update(batch_result.get('result') or {})
+    errors = batch_result.get('result_error') or {}
+
+    throttled = {name: pending[name] for name, error in errors.items()
+                 if error.get('error') == 'QUERY_LIMIT_EXCEEDED'}
+    failed = {name: error for name, error in errors.items() if name not in throttled}
+    if failed:
+        name, error = next(iter(failed.items()))
+        raise RuntimeError(f"[Ошибка API] Команда batch {name}: {error.get('error_description', error.get('error'))}")
+    return throttled
 
 
 class B24:
-    def __init__(self, domain: str, user_id: int, token: str):
+    def __init__(self, domain: str, user_id: int, token: str, session: requests.Session = None,
+                 limiter: RateLimiter = None, max_retries: int = 8, base_url: str = None):
         self.domain = domain
         self.user_id = user_id
         self.token = token
+        # Одна keep-alive сессия на клиента: TLS-соединение переиспользуется между запросами
+        self.session = session or make_session()
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        # Адрес портала вместо https://{domain} (прокси, локальный тестовый сервер)
+        self.base_url = base_url
+
+    def _url(self, url: str) -> str:
+        return (self.base_url or 'https://' + self.domain) + '/rest/' + str(self.user_id) + '/' + self.token + '/' + url
+
+    def _send(self, http_method: str, url: str, **kwargs) -> requests.Response:
+        """Отправляет запрос в рамках лимита и повторяет его с экспоненциальной задержкой, если портал ответил 503/429"""
+        for attempt in range(self.max_retries + 1):
+            METRICS.record_throttle('bitrix24', url, self.limiter.acquire(url))
+            started = time.perf_counter()
+            resp = self.session.request(http_method, self._url(url), **kwargs)
+            METRICS.record_http('bitrix24', url, resp.status_code, time.perf_counter() - started,
+                                body_size(resp.request.body), len(resp.content))
+            if resp.status_code not in THROTTLE_STATUSES or attempt == self.max_retries:
+                return resp
+            delay = backoff_delay(attempt)
+            self.limiter.penalize(delay)
+            print(f'QUERY_LIMIT_EXCEEDED, delay {delay:.1f}s')
+        return resp
+
+    def _post_json(self, url: str, json: dict = None) -> dict:
+        response = self._send('POST', url, json=json).json()
+        if response.get('error') == 'QUERY_LIMIT_EXCEEDED':
+            raise RuntimeError(f'[Ошибка API] Метод: {url} — лимит запросов не восстановился за {self.max_retries} попыток')
+        self.limiter.update_operating(url, response.get('time'))
+        return response
 
     def get(self, url: str, params: dict = None):
-        resp = requests.get('https://' + self.domain +
-                            '/rest/' + str(self.user_id) + '/' + self.token + '/' + url, params=params)
+        resp = self._send('GET', url, params=params)
         return resp
 
     def post(self, url: str, json: dict = None, data:dict = None, files:dict = None, wait_for_limit:bool = False):
+        resp = self._send('POST', url, json=json, files=files, data=data)
         if wait_for_limit:
-            for k in range(0, 5):
-                time.sleep(k*10)
-                resp = requests.post('https://' + self.domain +
-                                     '/rest/' + str(self.user_id) + '/' + self.token + '/' + url, json=json, files=files, data=data)
-
+            # Повторяем и при прочих ошибках API, но уже с экспоненциальной задержкой вместо фиксированной
+            for k in range(0, 4):
                 if 'error' not in resp.json().keys():
-                    return resp
-
-        resp = requests.post('https://' + self.domain +
-                             '/rest/' + str(self.user_id) + '/' + self.token + '/' + url, json=json, files=files,
-                             data=data)
+                    break
+                time.sleep(backoff_delay(k, base=5.0))
+                resp = self._send('POST', url, json=json, files=files, data=data)
         return resp
 
+    @staticmethod
+    def _list_params(start: int, b24_filter: dict = None, select: list = None, entityTypeId: int = None) -> dict:
+        data = {'start': start, 'filter': b24_filter}
+        if entityTypeId:
+            data['entityTypeId'] = entityTypeId
+        if select:
+            data['select'] = select
+        return data
+
     def get_list(self, url: str, b24_filter: dict = None, select: list = None, entityTypeId: int = None,
-                 total_count_only: bool=False):
+                 total_count_only: bool=False, batch: bool = False):
+        """
+        Выгружает все записи списочного метода (crm.lead.list, crm.deal.list, user.get, ...)
+
+        При batch=True после первой страницы (из нее узнаем total) остальные страницы
+        запрашиваются пачками до 50 штук за один вызов метода batch
+        """
+        if batch and not total_count_only:
+            return self._get_list_batch(url, b24_filter, select, entityTypeId)
+
         entities = []
 
         start_pos = 0
         total = 1
         while start_pos < total:
-            data = {'start': start_pos, 'filter': b24_filter}
-            if entityTypeId:
-                data['entityTypeId'] = entityTypeId
-            if select:
-                data['select'] = select
-            response = self.post(url, json=data).json()
-            if 'error' in response.keys():
-                if response['error'] == 'QUERY_LIMIT_EXCEEDED':
-                    time.sleep(5)
-                    print('delay 5s')
-                    continue
+            data = self._list_params(start_pos, b24_filter, select, entityTypeId)
+            response = self._post_json(url, json=data)
             start_pos += 50
             if 'total' not in response:
                 print('НЕТ ключа total в ответе:', response)
@@ -56,19 +143,125 @@ class B24:
                 return total
             if start_pos == 50:
                 print(url, 'Total_count =', total)
-            if start_pos % 1000 == 0:
-                time.sleep(1)
-                print('delay 1s')
             result = response['result']
             if entityTypeId:
                 result = result['items']
             for entity in result:
                 entities.append(entity)
         return entities
-    
+
+    def _get_list_batch(self, url: str, b24_filter: dict = None, select: list = None, entityTypeId: int = None):
+        # Первая страница обычным запросом - из нее узнаем total
+        response = self._post_json(url, json=self._list_params(0, b24_filter, select, entityTypeId))
+        if 'error' in response:
+            raise RuntimeError(f"[Ошибка API] Метод: {url} — {response.get('error_description', response['error'])}")
+
+        total = response.get('total', 0)
+        print(url, 'Total_count =', total)
+        entities = self._list_items(response['result'], entityTypeId)
+
+        # Остальные страницы - по 50 команд в одном batch-запросе
+        starts = list(range(PAGE_SIZE, total, PAGE_SIZE))
+        for i in range(0, len(starts), BATCH_MAX_COMMANDS):
+            chunk = starts[i:i + BATCH_MAX_COMMANDS]
+            commands = {
+                f'page_{start}': url + '?' + urlencode(_flatten_params(self._list_params(start, b24_filter, select, entityTypeId)))
+                for start in chunk
+            }
+            results = self.batch(commands)
+            for start in chunk:
+                entities.extend(self._list_items(results[f'page_{start}'], entityTypeId))
+        return entities
+
+    def iter_list(self, url: str, b24_filter: dict = None, select: list = None, entityTypeId: int = None,
+                  chunk_size: int = None):
+        """
+        Потоково выгружает записи списочного crm-метода, постранично по курсору >ID
+
+        В отличие от get_list не использует смещение start: каждая страница запрашивается
+        с фильтром >ID последней полученной записи и start=-1, поэтому Bitrix24 не считает
+        total и не пропускает строки, а записи не копятся в памяти
+
+        Args:
+            chunk_size: int - если задан, отдаются списки по chunk_size записей, иначе по одной записи
+
+        Yields:
+            dict - запись (или list записей при chunk_size)
+        """
+        id_field = 'id' if entityTypeId else 'ID'
+        page_filter = dict(b24_filter or {})
+        last_id = int(page_filter.pop(f'>{id_field}', 0))
+        if select and id_field not in select and '*' not in select:
+            select = [id_field] + list(select)
+
+        chunk = []
+        while True:
+            data = {'order': {id_field: 'ASC'}, 'filter': {**page_filter, f'>{id_field}': last_id}, 'start': -1}
+            if entityTypeId:
+                data['entityTypeId'] = entityTypeId
+            if select:
+                data['select'] = select
+            response = self._post_json(url, json=data)
+            if 'error' in response:
+                raise RuntimeError(f"[Ошибка API] Метод: {url} — {response.get('error_description', response['error'])}")
+
+            items = self._list_items(response['result'], entityTypeId)
+            if not items:
+                break
+            last_id = int(items[-1][id_field])
+
+            if chunk_size is None:
+                yield from items
+            else:
+                chunk.extend(items)
+                while len(chunk) >= chunk_size:
+                    yield chunk[:chunk_size]
+                    chunk = chunk[chunk_size:]
+
+            if len(items) < PAGE_SIZE:
+                break
+
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _list_items(result, entityTypeId: int = None) -> list:
+        if entityTypeId:
+            return result['items']
+        return result
+
+    def batch(self, commands: dict) -> dict:
+        """
+        Выполняет до 50 команд одним вызовом метода batch
+
+        Args:
+            commands: dict - имя команды -> строка вида 'crm.lead.list?start=50&filter[...]=...'
+
+        Returns:
+            dict - имя команды -> result этой команды
+        """
+        results = {}
+        pending = dict(commands)
+        attempt = 0
+        while pending:
+            response = self._post_json('batch', json={'halt': 0, 'cmd': pending})
+            if 'error' in response:
+                raise RuntimeError(f"[Ошибка API] Метод: batch — {response.get('error_description', response['error'])}")
+
+            throttled = _collect_batch_result(results, pending, response['result'])
+            if throttled:
+                if attempt == self.max_retries:
+                    raise RuntimeError(f'[Ошибка API] Метод: batch — лимит запросов не восстановился за {attempt} попыток')
+                delay = backoff_delay(attempt)
+                self.limiter.penalize(delay)
+                print(f'QUERY_LIMIT_EXCEEDED, delay {delay:.1f}s')
+                attempt += 1
+            pending = throttled
+        return results
+
     def call(self, method: str, params: dict = None):
         """Прямой вызов метода API Bitrix24, без использования get_list"""
-        response = self.post(method, json=params).json()
+        response = self._post_json(method, json=params)
         if 'error' in response:
             print(f"[Ошибка API] Метод: {method} — {response['error_description']}")
         return response
@@ -0,0 +1,153 @@
+import asyncio
+import json as jsonlib
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+
+from b24 import B24, BATCH_MAX_COMMANDS, PAGE_SIZE, THROTTLE_STATUSES, _collect_batch_result, _flatten_params
+from metrics import METRICS
+from rate_limiter import RateLimiter, backoff_delay
+
+
+def make_async_session(pool_size: int = 20) -> aiohttp.ClientSession:
+    """Сессия aiohttp с общим пулом keep-alive соединений для нескольких клиентов AsyncB24"""
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+
+
+class AsyncB24:
+    """
+    Асинхронный вариант клиента B24 на asyncio/aiohttp
+
+    Несколько клиентов (например, с разными токенами) могут работать через одну сессию
+    aiohttp, при этом у каждого свой RateLimiter, поэтому лимит соблюдается для каждого токена отдельно.
+    Страницы одного списка после первой запрашиваются конкурентно - темп задает лимитер.
+    """
+
+    def __init__(self, domain: str, user_id: int, token: str, session: aiohttp.ClientSession = None,
+                 limiter: RateLimiter = None, max_retries: int = 8, base_url: str = None):
+        self.domain = domain
+        self.user_id = user_id
+        self.token = token
+        self.session = session
+        self._own_session = session is None
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        # Адрес портала вместо https://{domain} (прокси, локальный тестовый сервер)
+        self.base_url = base_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        # Закрываем только сессию, созданную самим клиентом
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _url(self, url: str) -> str:
+        return (self.base_url or 'https://' + self.domain) + '/rest/' + str(self.user_id) + '/' + self.token + '/' + url
+
+    async def _post_json(self, url: str, json: dict = None) -> dict:
+        if self.session is None:
+            self.session = make_async_session()
+        # Тело сериализуем сами (как это сделал бы aiohttp), чтобы знать его размер для метрик
+        body = jsonlib.dumps(json).encode('utf-8')
+        for attempt in range(self.max_retries + 1):
+            wait = self.limiter.reserve(url)
+            if wait > 0:
+                METRICS.record_throttle('bitrix24', url, wait)
+                await asyncio.sleep(wait)
+            started = time.perf_counter()
+            async with self.session.post(self._url(url), data=body,
+                                         headers={'Content-Type': 'application/json'}) as resp:
+                status = resp.status
+                content = await resp.read()
+            METRICS.record_http('bitrix24', url, status, time.perf_counter() - started, len(body), len(content))
+            # Тело 503/429 не разбираем: перед порталом может стоять nginx/прокси со страницей ошибки в HTML
+            if status not in THROTTLE_STATUSES or attempt == self.max_retries:
+                break
+            delay = backoff_delay(attempt)
+            self.limiter.penalize(delay)
+            print(f'QUERY_LIMIT_EXCEEDED, delay {delay:.1f}s')
+
+        response = jsonlib.loads(content)
+        if response.get('error') == 'QUERY_LIMIT_EXCEEDED':
+            raise RuntimeError(f'[Ошибка API] Метод: {url} — лимит запросов не восстановился за {self.max_retries} попыток')
+        self.limiter.update_operating(url, response.get('time'))
+        return response
+
+    async def get_list(self, url: str, b24_filter: dict = None, select: list = None, entityTypeId: int = None,
+                       total_count_only: bool = False, batch: bool = False):
+        """То же, что B24.get_list: возвращает все записи списочного метода одним списком"""
+        response = await self._post_json(url, json=B24._list_params(0, b24_filter, select, entityTypeId))
+        if 'error' in response:
+            raise RuntimeError(f"[Ошибка API] Метод: {url} — {response.get('error_description', response['error'])}")
+        if 'total' not in response:
+            print('НЕТ ключа total в ответе:', response)
+        total = response.get('total', 0)
+        if total_count_only:
+            return total
+        print(url, 'Total_count =', total)
+
+        starts = list(range(PAGE_SIZE, total, PAGE_SIZE))
+        if batch:
+            chunks = [starts[i:i + BATCH_MAX_COMMANDS] for i in range(0, len(starts), BATCH_MAX_COMMANDS)]
+            results = await asyncio.gather(*(self._fetch_batch_pages(url, chunk, b24_filter, select, entityTypeId)
+                                             for chunk in chunks))
+            pages = [page for chunk_pages in results for page in chunk_pages]
+        else:
+            pages = await asyncio.gather(*(self._fetch_page(url, start, b24_filter, select, entityTypeId)
+                                           for start in starts))
+
+        entities = B24._list_items(response['result'], entityTypeId)
+        for page in pages:
+            entities.extend(page)
+        return entities
+
+    async def _fetch_page(self, url: str, start: int, b24_filter: dict = None, select: list = None,
+                          entityTypeId: int = None) -> list:
+        response = await self._post_json(url, json=B24._list_params(start, b24_filter, select, entityTypeId))
+        if 'error' in response:
+            raise RuntimeError(f"[Ошибка API] Метод: {url} — {response.get('error_description', response['error'])}")
+        return B24._list_items(response['result'], entityTypeId)
+
+    async def _fetch_batch_pages(self, url: str, starts: list, b24_filter: dict = None, select: list = None,
+                                 entityTypeId: int = None) -> list:
+        commands = {
+            f'page_{start}': url + '?' + urlencode(_flatten_params(B24._list_params(start, b24_filter, select, entityTypeId)))
+            for start in starts
+        }
+        results = await self.batch(commands)
+        return [B24._list_items(results[f'page_{start}'], entityTypeId) for start in starts]
+
+    async def batch(self, commands: dict) -> dict:
+        """То же, что B24.batch: выполняет до 50 команд одним вызовом"""
+        results = {}
+        pending = dict(commands)
+        attempt = 0
+        while pending:
+            response = await self._post_json('batch', json={'halt': 0, 'cmd': pending})
+            if 'error' in response:
+                raise RuntimeError(f"[Ошибка API] Метод: batch — {response.get('error_description', response['error'])}")
+
+            throttled = _collect_batch_result(results, pending, response['result'])
+            if throttled:
+                if attempt == self.max_retries:
+                    raise RuntimeError(f'[Ошибка API] Метод: batch — лимит запросов не восстановился за {attempt} попыток')
+                delay = backoff_delay(attempt)
+                self.limiter.penalize(delay)
+                print(f'QUERY_LIMIT_EXCEEDED, delay {delay:.1f}s')
+                attempt += 1
+            pending = throttled
+        return results
+
+    async def call(self, method: str, params: dict = None):
+        """Прямой вызов метода API Bitrix24, без использования get_list"""
+        response = await self._post_json(method, json=params)
+        if 'error' in response:
+            print(f"[Ошибка API] Метод: {method} — {response['error_description']}")
+        return response
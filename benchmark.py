@@ -0,0 +1,342 @@
+"""
+Бенчмарк отчета на локальном тестовом сервере вместо портала Bitrix24 и Telegram
+
+Сервер отдает crm.lead.list, crm.deal.list, user.get, crm.status.list и batch на синтетических
+данных заданного объема, с заданной долей ответов QUERY_LIMIT_EXCEEDED и задержкой сети,
+а также принимает sendMessage/sendPhoto/sendDocument как Bot API. Замеряются:
+    - скорость выгрузки списка разными способами (страницы, batch, курсор >ID, async);
+    - время полного отчета fetch -> compute -> render -> export -> deliver по стадиям;
+    - пик памяти полного отчета (tracemalloc) и пик RSS процесса.
+
+Пример:
+    python benchmark.py --leads 20000 --deals 2000 --throttle-rate 0.05 --latency-ms 20 --json bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from b24 import PAGE_SIZE, B24, make_session
+from b24_async import AsyncB24, make_async_session
+from metrics import METRICS
+from pipeline import STAGES, ReportConfig, run_report
+from rate_limiter import RateLimiter
+
+FETCH_MODES = ('pages', 'batch', 'keyset', 'async-pages', 'async-batch')
+UTM_SOURCES = ['facebook', 'instagram', 'tiktok', 'google', 'site', None]
+
+
+def _unflatten(pairs: list) -> dict:
+    """Обратное к b24._flatten_params: filter[>=ID]=1 -> {'filter': {'>=ID': '1'}}"""
+    params = {}
+    for key, value in pairs:
+        parts = re.findall(r'[^\[\]]+', key)
+        node = params
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return params
+
+
+class FakePortal:
+    """
+    Тестовый сервер с синтетическими данными одного отчетного дня
+
+    Фильтры запросов, кроме курсора >ID, не применяются: все лиды и сделки и так относятся
+    к отчетному дню. Ответы идут страницами по 50 записей с total и ключом time, как у портала.
+
+    Args:
+        leads, deals, users, statuses: int - объем данных
+        throttle_rate: float - доля запросов (и команд batch), на которые приходит QUERY_LIMIT_EXCEEDED
+        latency_ms: float - задержка каждого ответа
+        telegram_throttle_rate: float - доля запросов к Bot API, на которые приходит 429
+    """
+
+    def __init__(self, leads: int = 10000, deals: int = 1000, users: int = 30, statuses: int = 8,
+                 report_date: str = '2025-01-15', throttle_rate: float = 0.0, latency_ms: float = 0.0,
+                 telegram_throttle_rate: float = 0.0, seed: int = 42):
+        self.report_date = report_date
+        self.throttle_rate = throttle_rate
+        self.latency = latency_ms / 1000
+        self.telegram_throttle_rate = telegram_throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.datasets = self._generate(leads, deals, users, statuses)
+        self._server = None
+
+    def _generate(self, leads: int, deals: int, users: int, statuses: int) -> dict:
+        rnd = self._random
+        day = datetime.fromisoformat(self.report_date)
+        status_ids = ['NEW', 'IN_PROCESS', 'PROCESSED', 'CONVERTED', 'JUNK'] + \
+            [f'UC_{i}' for i in range(max(0, statuses - 5))]
+        status_ids = status_ids[:statuses]
+
+        def moment(at: datetime) -> str:
+            return at.strftime('%Y-%m-%dT%H:%M:%S+03:00')
+
+        lead_list = []
+        for i in range(1, leads + 1):
+            created = day + timedelta(seconds=rnd.randint(1, 86398))
+            taken = created + timedelta(minutes=rnd.expovariate(1 / 30)) if rnd.random() > 0.1 else None
+            lead_list.append({
+                'ID': str(i), 'STATUS_ID': rnd.choice(status_ids), 'ASSIGNED_BY_ID': str(rnd.randint(1, users)),
+                'DATE_CREATE': moment(created), 'DATE_MODIFY': moment(taken or created),
+                'UTM_SOURCE': rnd.choice(UTM_SOURCES), 'UF_CRM_1745414446': moment(taken) if taken else None,
+            })
+        deal_list = []
+        for i in range(1, deals + 1):
+            closed = day + timedelta(seconds=rnd.randint(1, 86398))
+            deal_list.append({
+                'ID': str(i), 'OPPORTUNITY': f'{rnd.randint(100, 50000)}.00', 'ASSIGNED_BY_ID': str(rnd.randint(1, users)),
+                'CLOSEDATE': moment(closed), 'DATE_MODIFY': moment(closed), 'UTM_SOURCE': rnd.choice(UTM_SOURCES),
+                'UF_CRM_1695636781': None, 'STAGE_ID': 'WON', 'CATEGORY_ID': '0',
+            })
+        user_list = [{'ID': str(i), 'NAME': f'Имя{i}', 'LAST_NAME': f'Фамилия{i}', 'SECOND_NAME': None}
+                     for i in range(1, users + 1)]
+        status_list = [{'ID': str(i), 'STATUS_ID': status_id, 'NAME': f'Стадия {status_id}', 'ENTITY_ID': 'STATUS'}
+                       for i, status_id in enumerate(status_ids, 1)]
+        return {'crm.lead.list': lead_list, 'crm.deal.list': deal_list,
+                'user.get': user_list, 'crm.status.list': status_list}
+
+    def _throttled(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def list_result(self, method: str, params: dict) -> dict:
+        """Ответ списочного метода: страница по start или, при start=-1, по курсору >ID"""
+        records = self.datasets[method]
+        b24_filter = params.get('filter') or {}
+        start = int(params.get('start') or 0)
+        if '>ID' in b24_filter:
+            last_id = int(b24_filter['>ID'])
+            # Записи отсортированы по ID, поэтому курсор - это просто смещение
+            records = records[last_id:]
+        page = records[:PAGE_SIZE] if start < 0 else records[start:start + PAGE_SIZE]
+
+        # user.get и crm.status.list, как и на портале, отдают все поля независимо от select
+        select = params.get('select') if method in ('crm.lead.list', 'crm.deal.list') else None
+        if isinstance(select, dict):
+            select = list(select.values())
+        if select and '*' not in select:
+            page = [{key: record.get(key) for key in select} for record in page]
+
+        response = {'result': page}
+        if start >= 0:
+            response['total'] = len(records)
+            if start + PAGE_SIZE < len(records):
+                response['next'] = start + PAGE_SIZE
+        return response
+
+    def handle_rest(self, method: str, params: dict):
+        """Возвращает (HTTP статус, ответ) метода REST API"""
+        if self._throttled(self.throttle_rate):
+            return 503, {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'}
+        operating = {'start': time.time(), 'operating': 0.01, 'operating_reset_at': time.time() + 600}
+
+        if method == 'batch':
+            result, result_error = {}, {}
+            for name, command in (params.get('cmd') or {}).items():
+                if self._throttled(self.throttle_rate):
+                    result_error[name] = {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'}
+                    continue
+                command_method, _, query = command.partition('?')
+                if command_method not in self.datasets:
+                    result_error[name] = {'error': 'ERROR_METHOD_NOT_FOUND', 'error_description': command_method}
+                    continue
+                result[name] = self.list_result(command_method, _unflatten(parse_qsl(query)))['result']
+            return 200, {'result': {'result': result, 'result_error': result_error}, 'time': operating}
+
+        if method not in self.datasets:
+            return 404, {'error': 'ERROR_METHOD_NOT_FOUND', 'error_description': f'Method not found: {method}'}
+        return 200, {**self.list_result(method, params), 'time': operating}
+
+    def handle_telegram(self, method: str):
+        if self._throttled(self.telegram_throttle_rate):
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                         'parameters': {'retry_after': 1}}
+        with self._lock:
+            file_id = f'file_{self._random.getrandbits(32):08x}'
+        results = {
+            'sendPhoto': {'photo': [{'file_id': file_id + '_s'}, {'file_id': file_id}]},
+            'sendDocument': {'document': {'file_id': file_id}},
+        }
+        return 200, {'ok': True, 'result': {'message_id': 1, **results.get(method, {})}}
+
+    def start(self) -> str:
+        """Запускает сервер в фоновом потоке и возвращает его адрес"""
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят разными send: без TCP_NODELAY keep-alive клиент ждет delayed ACK ~40 мс
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if portal.latency:
+                    time.sleep(portal.latency)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1].split('?')[0]
+                if self.path.startswith('/rest/'):
+                    params = json.loads(body) if body else {}
+                    status, payload = portal.handle_rest(method, params or {})
+                else:
+                    status, payload = portal.handle_telegram(method)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        class Server(ThreadingHTTPServer):
+            # Очередь listen по умолчанию - 5 соединений: пул async-клиента не успевает подключиться
+            # и ждет повтора SYN ~1 с
+            request_queue_size = 128
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _http_calls() -> int:
+    return sum(h['calls'] for h in METRICS.snapshot()['http'])
+
+
+def bench_fetch(base_url: str, mode: str, rate: float) -> dict:
+    """Выгружает все лиды способом mode и возвращает скорость выгрузки"""
+    METRICS.reset()
+    limiter = RateLimiter(rate=rate, burst=PAGE_SIZE)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode.startswith('async'):
+            async def fetch():
+                async with make_async_session() as session:
+                    client = AsyncB24('bench', 1, 'token', session=session, limiter=limiter, base_url=base_url)
+                    return await client.get_list('crm.lead.list', batch=mode == 'async-batch')
+            rows = len(asyncio.run(fetch()))
+        else:
+            client = B24('bench', 1, 'token', session=make_session(), limiter=limiter, base_url=base_url)
+            if mode == 'keyset':
+                rows = sum(len(chunk) for chunk in client.iter_list('crm.lead.list', chunk_size=1000))
+            else:
+                rows = len(client.get_list('crm.lead.list', batch=mode == 'batch'))
+    seconds = time.perf_counter() - started
+    return {'mode': mode, 'rows': rows, 'seconds': round(seconds, 4), 'rows_per_second': round(rows / seconds),
+            'requests': _http_calls()}
+
+
+def bench_report(base_url: str, report_date: str, stages: list, repeat: int) -> dict:
+    """Полный отчет: медиана времени по repeat запускам, время стадий последнего запуска и пик памяти"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        config = ReportConfig(domain='bench', user_id=1, token_leads='leads', token_users='users',
+                              token_status='status', report_date=report_date, telegram_token='bot',
+                              chat_ids=[101, 102, 103, 104, 105], crm_url='https://bench.bitrix24.ua',
+                              cache_dir=cache_dir, cache_refresh=True,
+                              b24_base_url=base_url, telegram_api_url=base_url)
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_report(config, stages)
+
+        # Первый запуск прогревает импорты и кэш шрифтов matplotlib и в замер не входит
+        run()
+        latencies = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - started)
+        snapshot = METRICS.snapshot()
+
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'stages': stages,
+        'latency_seconds': round(statistics.median(latencies), 4),
+        'latency_min_seconds': round(min(latencies), 4),
+        'steps': {name: timing['seconds'] for name, timing in snapshot['timings'].items()},
+        'requests': sum(h['calls'] for h in snapshot['http']),
+        'throttle_wait_seconds': round(sum(t['seconds'] for t in snapshot['throttle']), 4),
+        'peak_traced_mb': round(peak / 2 ** 20, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк отчета на локальном тестовом сервере')
+    parser.add_argument('--leads', type=int, default=10000)
+    parser.add_argument('--deals', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--statuses', type=int, default=8)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='доля ответов QUERY_LIMIT_EXCEEDED')
+    parser.add_argument('--telegram-throttle-rate', type=float, default=0.0, help='доля ответов 429 от Telegram')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='задержка каждого ответа сервера')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='запросов в секунду для лимитера при замере выгрузки (2 - как у портала)')
+    parser.add_argument('--modes', default=','.join(FETCH_MODES), help='способы выгрузки через запятую')
+    parser.add_argument('--stages', default=','.join(STAGES), help='стадии полного отчета через запятую')
+    parser.add_argument('--repeat', type=int, default=3, help='сколько раз повторить полный отчет')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='сохранить результаты в JSON файл')
+    args = parser.parse_args(argv)
+
+    report_date = '2025-01-15'
+    portal = FakePortal(args.leads, args.deals, args.users, args.statuses, report_date=report_date,
+                        throttle_rate=args.throttle_rate, latency_ms=args.latency_ms,
+                        telegram_throttle_rate=args.telegram_throttle_rate, seed=args.seed)
+    base_url = portal.start()
+    try:
+        print(f'Данные: {args.leads} лидов, {args.deals} сделок, {args.users} менеджеров; '
+              f'QUERY_LIMIT_EXCEEDED {args.throttle_rate:.0%}, задержка {args.latency_ms:g} мс')
+
+        fetch_results = []
+        for mode in (mode.strip() for mode in args.modes.split(',') if mode.strip()):
+            result = bench_fetch(base_url, mode, args.rate)
+            fetch_results.append(result)
+            print(f"  выгрузка {mode:<12} {result['rows']:>8} строк  {result['seconds']:>8.3f} с  "
+                  f"{result['rows_per_second']:>9} строк/с  {result['requests']:>5} запросов")
+
+        stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+        report = bench_report(base_url, report_date, stages, args.repeat)
+        print(f"  полный отчет: {report['latency_seconds']:.3f} с (медиана из {args.repeat}), "
+              f"{report['requests']} запросов, ожидание лимитов {report['throttle_wait_seconds']:.3f} с")
+        for name, seconds in report['steps'].items():
+            print(f'    {name:<16} {seconds:.3f} с')
+        print(f"  пик памяти отчета (tracemalloc): {report['peak_traced_mb']} МБ, "
+              f"пик RSS процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МБ")
+    finally:
+        portal.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'fetch': fetch_results, 'report': report}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
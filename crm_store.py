@@ -0,0 +1,229 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+# Операторы фильтра в стиле Bitrix24 ('>=DATE_CREATE', '!STAGE_ID', ...) и их SQL-аналоги
+FILTER_OPERATORS = (('>=', '>='), ('<=', '<='), ('!=', '!='), ('>', '>'), ('<', '<'), ('!', '!='), ('=', '='))
+RANGE_OPERATORS = ('>=', '<=', '>', '<')
+
+# Запас watermark назад от начала синхронизации: расхождение часов с порталом и записи, которые
+# сохранялись, пока шел запрос. Повторная загрузка пары записей безопасна - upsert идемпотентен
+SYNC_OVERLAP = timedelta(minutes=5)
+# Даты Bitrix24 сравниваются по первым 19 символам (YYYY-MM-DDTHH:MM:SS): у сохраненных значений
+# есть смещение (+03:00), а у границ фильтра обычно нет, и '...23:59:59+03:00' > '...23:59:59' как строка
+DATETIME_PREFIX = 19
+# Сколько ID перепроверяется одним запросом при сверке удаленных записей
+RECONCILE_CHUNK = 500
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _parse_filter_key(key: str):
+    for prefix, operator in FILTER_OPERATORS:
+        if key.startswith(prefix):
+            return key[len(prefix):], operator
+    return key, '='
+
+
+def filter_fields(b24_filter: dict) -> list:
+    """Поля, по которым фильтрует b24_filter: {'>=DATE_CREATE': ..., 'STAGE_ID': ...} -> ['DATE_CREATE', 'STAGE_ID']"""
+    return [_parse_filter_key(key)[0] for key in (b24_filter or {})]
+
+
+class CrmStore:
+    """
+    Локальное хранилище лидов и сделок в SQLite с инкрементальной синхронизацией
+
+    Каждая сущность (leads, deals) - отдельная таблица с ключом ID и колонками по полям select.
+    sync() выгружает только записи, у которых DATE_MODIFY не раньше начала прошлой синхронизации
+    (watermark, с запасом SYNC_OVERLAP), и обновляет их по ID - так подтягиваются изменения taken_in_work и STATUS_ID,
+    сделанные после создания лида. Отчет за любой период потом читается через select() без API.
+    Удаления delta-синхронизация не видит, поэтому записи окна отчета сверяются с порталом через reconcile().
+
+    Args:
+        path: str - путь к файлу базы SQLite
+    """
+
+    def __init__(self, path: str = 'crm_store.sqlite'):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS sync_state (entity TEXT PRIMARY KEY, watermark TEXT)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # Соединение на каждую операцию - хранилище можно использовать из разных потоков
+        return sqlite3.connect(self.path)
+
+    @staticmethod
+    def _columns(conn: sqlite3.Connection, entity: str) -> list:
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({_quote(entity)})')]
+
+    def _ensure_table(self, conn: sqlite3.Connection, entity: str, fields) -> list:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {_quote(entity)} ("ID" INTEGER PRIMARY KEY)')
+        columns = self._columns(conn, entity)
+        for field in fields:
+            if field not in columns:
+                conn.execute(f'ALTER TABLE {_quote(entity)} ADD COLUMN {_quote(field)} TEXT')
+                columns.append(field)
+        return columns
+
+    def upsert(self, entity: str, records: list) -> int:
+        """Вставляет записи или обновляет существующие по ID. Возвращает количество записей"""
+        if not records:
+            return 0
+        fields = list(dict.fromkeys(field for record in records for field in record))
+        if 'ID' not in fields:
+            raise ValueError(f'В записях {entity} нет поля ID')
+
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f'{_quote(field)} = excluded.{_quote(field)}' for field in fields if field != 'ID')
+        query = (f'INSERT INTO {_quote(entity)} ({", ".join(_quote(field) for field in fields)}) '
+                 f'VALUES ({placeholders}) ON CONFLICT("ID") DO UPDATE SET {updates}')
+        rows = [
+            tuple(json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value
+                  for value in (record.get(field) for field in fields))
+            for record in records
+        ]
+        with closing(self._connect()) as conn, conn:
+            self._ensure_table(conn, entity, fields)
+            conn.executemany(query, rows)
+        return len(rows)
+
+    def watermark(self, entity: str):
+        """DATE_MODIFY, начиная с которого нужна следующая синхронизация (None - синхронизаций не было)"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT watermark FROM sync_state WHERE entity = ?', (entity,)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, entity: str, watermark: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT INTO sync_state (entity, watermark) VALUES (?, ?) '
+                         'ON CONFLICT(entity) DO UPDATE SET watermark = excluded.watermark', (entity, watermark))
+
+    def sync(self, client, entity: str, url: str, select: list, b24_filter: dict = None,
+             initial_since: str = None, chunk_size: int = 500) -> int:
+        """
+        Догружает из Bitrix24 записи, измененные после последней синхронизации
+
+        Args:
+            client: B24 - клиент для выгрузки (используется iter_list)
+            entity: str - имя таблицы (leads, deals)
+            url: str - списочный метод (crm.lead.list, crm.deal.list)
+            select: list - поля; DATE_MODIFY добавляется автоматически. Если среди них есть поле, которого
+                еще нет в таблице, сущность синхронизируется заново целиком: delta по DATE_MODIFY
+                не заполнила бы новое поле у записей, которые с тех пор не менялись
+            b24_filter: dict - постоянный фильтр выгрузки
+            initial_since: str - при первой синхронизации брать только записи с DATE_MODIFY от этой даты
+
+        Returns:
+            int - сколько записей загружено
+        """
+        if 'DATE_MODIFY' not in select:
+            select = list(select) + ['DATE_MODIFY']
+        sync_filter = dict(b24_filter or {})
+        with closing(self._connect()) as conn:
+            existing = self._columns(conn, entity)
+        new_fields = [field for field in select if existing and field not in existing]
+        if new_fields:
+            # Watermark сбрасываем до выгрузки: если она прервется, следующая синхронизация тоже будет полной
+            print(f'{entity}: новые поля {", ".join(new_fields)}, полная синхронизация')
+            with closing(self._connect()) as conn, conn:
+                conn.execute('DELETE FROM sync_state WHERE entity = ?', (entity,))
+        # >= а не >: записи, измененные в ту же секунду после прошлой выгрузки, не потеряются (upsert идемпотентен)
+        since = self.watermark(entity) or initial_since
+        if since:
+            sync_filter['>=DATE_MODIFY'] = since
+
+        # Watermark - время начала синхронизации, а не максимальный DATE_MODIFY в выгрузке: iter_list идет
+        # по возрастанию ID, и запись с меньшим ID, измененная после того, как курсор ее прошел, в эту выгрузку
+        # не попадет, а максимальный DATE_MODIFY (запись с большим ID, измененная еще позже) ее бы перескочил
+        started = datetime.now().astimezone()
+        loaded = 0
+        for chunk in client.iter_list(url, b24_filter=sync_filter, select=select, chunk_size=chunk_size):
+            loaded += self.upsert(entity, chunk)
+        # Watermark двигаем только после полной выгрузки, чтобы прерванная синхронизация повторилась
+        watermark = (started - SYNC_OVERLAP).isoformat(timespec='seconds')
+        self._set_watermark(entity, watermark)
+        print(f'{entity}: синхронизировано {loaded} записей, watermark = {watermark}')
+        return loaded
+
+    def delete(self, entity: str, ids) -> int:
+        ids = [int(value) for value in ids]
+        if not ids:
+            return 0
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(f'DELETE FROM {_quote(entity)} WHERE "ID" = ?', [(value,) for value in ids])
+        return len(ids)
+
+    def reconcile(self, client, entity: str, url: str, select: list, b24_filter: dict) -> int:
+        """
+        Удаляет записи окна b24_filter, которых больше нет в Bitrix24 (удалены или объединены как дубли)
+
+        Выгружаются только ID записей окна; локальные записи окна, которых среди них нет, перепроверяются
+        по @ID: найденные (изменились и вышли из окна) обновляются, не найденные удаляются.
+
+        Returns:
+            int - сколько записей удалено
+        """
+        remote_ids = {int(record['ID']) for chunk in client.iter_list(url, b24_filter=b24_filter, select=['ID'],
+                                                                      chunk_size=RECONCILE_CHUNK)
+                      for record in chunk}
+        local_ids = {int(record['ID']) for record in self.select(entity, b24_filter, columns=['ID'])}
+        candidates = sorted(local_ids - remote_ids)
+
+        found = set()
+        for start in range(0, len(candidates), RECONCILE_CHUNK):
+            ids = candidates[start:start + RECONCILE_CHUNK]
+            for chunk in client.iter_list(url, b24_filter={'@ID': ids}, select=select, chunk_size=RECONCILE_CHUNK):
+                self.upsert(entity, chunk)
+                found.update(int(record['ID']) for record in chunk)
+        deleted = self.delete(entity, [value for value in candidates if value not in found])
+        if deleted:
+            print(f'{entity}: удалено {deleted} записей, которых больше нет в Bitrix24')
+        return deleted
+
+    def select(self, entity: str, b24_filter: dict = None, columns: list = None) -> list:
+        """
+        Читает записи из хранилища с фильтром в стиле Bitrix24
+
+        Поддерживаются ключи вида 'FIELD', '>=FIELD', '<=FIELD', '>FIELD', '<FIELD', '!FIELD';
+        значение-список означает IN. Сравнения больше/меньше идут по первым 19 символам значения
+        (дата и время без смещения). Возвращает list of dict, как get_list.
+        """
+        with closing(self._connect()) as conn, conn:
+            existing = self._columns(conn, entity)
+            if not existing:
+                return []
+            conditions, params = [], []
+            for key, value in (b24_filter or {}).items():
+                field, operator = _parse_filter_key(key)
+                if field not in existing:
+                    raise ValueError(f'В хранилище {entity} нет поля {field}')
+                if operator in RANGE_OPERATORS and field != 'ID':
+                    expression = f'substr({_quote(field)}, 1, {DATETIME_PREFIX})'
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS {_quote(f"idx_{entity}_{field}_datetime")} '
+                                 f'ON {_quote(entity)} ({expression})')
+                    conditions.append(f'{expression} {operator} ?')
+                    params.append(str(value)[:DATETIME_PREFIX])
+                elif isinstance(value, (list, tuple, set)):
+                    negate = 'NOT ' if operator == '!=' else ''
+                    conditions.append(f'{_quote(field)} {negate}IN ({", ".join("?" for _ in value)})')
+                    params.extend(str(item) for item in value)
+                else:
+                    conditions.append(f'{_quote(field)} {operator} ?')
+                    params.append(str(value))
+
+            columns = [column for column in (columns or existing) if column in existing]
+            query = f'SELECT {", ".join(_quote(column) for column in columns)} FROM {_quote(entity)}'
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            rows = conn.execute(query, params).fetchall()
+
+        records = [dict(zip(columns, row)) for row in rows]
+        if 'ID' in columns:
+            for record in records:
+                record['ID'] = str(record['ID'])
+        return records
@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Префикс имен метрик в формате Prometheus
+PROMETHEUS_PREFIX = 'leads_report'
+
+
+def body_size(body) -> int:
+    """Размер тела запроса в байтах (str, bytes или None)"""
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        # Потоковое тело (генератор, файл) - размер заранее неизвестен
+        return 0
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+class Metrics:
+    """
+    Счетчики одного запуска отчета: время стадий, HTTP-вызовы по методам, ожидание лимитов,
+    объем переданных данных и количество обработанных строк
+
+    Клиенты B24, AsyncB24, TelegramSender и стадии pipeline пишут в общий реестр METRICS,
+    в конце запуска он выгружается в JSON (snapshot/to_json) и, при необходимости,
+    в текстовом формате Prometheus (write_prometheus) для node_exporter textfile collector.
+    Все методы потокобезопасны.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._started = time.time()
+            self._started_monotonic = time.perf_counter()
+            self._timings = {}
+            self._http = {}
+            self._throttle = {}
+            self._rows = {}
+
+    @contextmanager
+    def timer(self, name: str):
+        """Засекает время блока кода: стадии (stage:fetch) или отдельного шага (working_hours)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.perf_counter() - started)
+
+    def add_timing(self, name: str, seconds: float):
+        with self._lock:
+            count, total = self._timings.get(name, (0, 0.0))
+            self._timings[name] = (count + 1, total + seconds)
+
+    def record_http(self, service: str, endpoint: str, status: int, seconds: float,
+                    bytes_sent: int = 0, bytes_received: int = 0):
+        """Один HTTP-запрос к сервису (bitrix24, telegram) по методу API endpoint"""
+        with self._lock:
+            stats = self._http.setdefault((service, endpoint), {
+                'calls': 0, 'statuses': {}, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0})
+            stats['calls'] += 1
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['seconds'] += seconds
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+
+    def record_throttle(self, service: str, endpoint: str, seconds: float):
+        """Ожидание лимита перед запросом (token bucket, operating, retry_after, задержка после 503/429)"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            waits, total = self._throttle.get((service, endpoint), (0, 0.0))
+            self._throttle[(service, endpoint)] = (waits + 1, total + seconds)
+
+    def add_rows(self, dataset: str, rows: int):
+        with self._lock:
+            self._rows[dataset] = self._rows.get(dataset, 0) + rows
+
+    def snapshot(self) -> dict:
+        """Все метрики запуска одним словарем, пригодным для json.dumps"""
+        with self._lock:
+            return {
+                'started_at': self._started,
+                'total_seconds': round(time.perf_counter() - self._started_monotonic, 6),
+                'timings': {name: {'count': count, 'seconds': round(total, 6)}
+                            for name, (count, total) in self._timings.items()},
+                'http': [{'service': service, 'endpoint': endpoint, **stats,
+                          'seconds': round(stats['seconds'], 6),
+                          'statuses': {str(status): n for status, n in stats['statuses'].items()}}
+                         for (service, endpoint), stats in self._http.items()],
+                'throttle': [{'service': service, 'endpoint': endpoint, 'waits': waits, 'seconds': round(total, 6)}
+                             for (service, endpoint), (waits, total) in self._throttle.items()],
+                'rows': dict(self._rows),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False)
+
+    def to_prometheus(self) -> str:
+        """Метрики в текстовом формате экспозиции Prometheus"""
+        snapshot = self.snapshot()
+        p = PROMETHEUS_PREFIX
+        lines = [
+            f'# TYPE {p}_run_seconds gauge',
+            f'{p}_run_seconds {snapshot["total_seconds"]}',
+            f'# TYPE {p}_run_started_timestamp_seconds gauge',
+            f'{p}_run_started_timestamp_seconds {snapshot["started_at"]}',
+            f'# TYPE {p}_step_seconds gauge',
+            *(f'{p}_step_seconds{_labels(step=name)} {t["seconds"]}' for name, t in snapshot['timings'].items()),
+            f'# TYPE {p}_http_requests_total counter',
+            *(f'{p}_http_requests_total{_labels(service=h["service"], endpoint=h["endpoint"], status=status)} {n}'
+              for h in snapshot['http'] for status, n in h['statuses'].items()),
+            f'# TYPE {p}_http_request_seconds_total counter',
+            *(f'{p}_http_request_seconds_total{_labels(service=h["service"], endpoint=h["endpoint"])} {h["seconds"]}'
+              for h in snapshot['http']),
+            f'# TYPE {p}_http_sent_bytes_total counter',
+            *(f'{p}_http_sent_bytes_total{_labels(service=h["service"], endpoint=h["endpoint"])} {h["bytes_sent"]}'
+              for h in snapshot['http']),
+            f'# TYPE {p}_http_received_bytes_total counter',
+            *(f'{p}_http_received_bytes_total{_labels(service=h["service"], endpoint=h["endpoint"])} '
+              f'{h["bytes_received"]}' for h in snapshot['http']),
+            f'# TYPE {p}_throttle_wait_seconds_total counter',
+            *(f'{p}_throttle_wait_seconds_total{_labels(service=t["service"], endpoint=t["endpoint"])} {t["seconds"]}'
+              for t in snapshot['throttle']),
+            f'# TYPE {p}_throttle_waits_total counter',
+            *(f'{p}_throttle_waits_total{_labels(service=t["service"], endpoint=t["endpoint"])} {t["waits"]}'
+              for t in snapshot['throttle']),
+            f'# TYPE {p}_rows_total counter',
+            *(f'{p}_rows_total{_labels(dataset=dataset)} {rows}' for dataset, rows in snapshot['rows'].items()),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        # Атомарная подмена файла, чтобы collector не прочитал его наполовину записанным
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def emit(self, json_path: str = None, prometheus_path: str = None):
+        """Печатает метрики запуска одной строкой JSON и сохраняет их в файлы, если пути заданы"""
+        text = self.to_json()
+        print('METRICS', text)
+        if json_path:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+
+
+# Общий реестр метрик процесса
+METRICS = Metrics()
@@ -0,0 +1,316 @@
+"""
+Мониторинг времени реакции на лиды в течение дня
+
+Раз в --interval секунд выгружает только лиды, измененные с прошлого опроса (>=DATE_MODIFY),
+и обновляет скользящие показатели за последние --window-hours часов: медиану времени реакции
+по каждому менеджеру (без обрезки) и по отделу (с обрезкой выбросов 1%-95%, как в ежедневном отчете).
+Если лид не взят в работу за REACTION_ALERT_SECONDS рабочего времени и не закрыт (CONVERTED, JUNK),
+в Telegram уходит алерт - все просроченные за один опрос лиды одним сообщением. Алерт отправляется
+только по срокам, наступившим после запуска монитора, поэтому перезапуск не повторяет алерты за окно.
+
+Значения хранятся в отсортированных списках, поэтому событие по лиду - это вставка/удаление
+через bisect, а медиана и квантили - O(1) по индексам, без пересчета всего дня. Срок алерта
+для каждого ожидающего лида считается один раз (add_working_hours) и лежит в куче.
+Изменения можно подавать и без опроса - через LeadMonitor.handle_lead (например, из вебхука ONCRMLEADUPDATE).
+
+Запуск:
+    python monitor.py --interval 60 --window-hours 24
+    python monitor.py --dry-run                       # алерты только в консоль
+"""
+import argparse
+import heapq
+import time
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from crm_store import SYNC_OVERLAP
+from metrics import METRICS
+from report import LEAD_SELECT, REACTION_ALERT_SECONDS, format_time_no_microseconds
+from working_hours import add_working_hours, calculate_working_hours
+
+# Семантика закрытых стадий лида: S - сконвертирован, F - некачественный (JUNK)
+FINAL_STATUS_SEMANTICS = ('S', 'F')
+FINAL_STATUSES = ('CONVERTED', 'JUNK')
+# Ограничение Telegram на длину сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Пауза после ошибки опроса растет вдвое до этого значения (секунды)
+MAX_ERROR_BACKOFF = 600
+
+
+class SortedWindow:
+    """
+    Набор значений по ключам (ID лида) в отсортированном виде
+
+    add/remove - O(log n) поиск + сдвиг списка, quantile/median/trimmed_median - O(1) и O(log n).
+    Квантили считаются с линейной интерполяцией, как pandas.Series.quantile
+    """
+
+    def __init__(self):
+        self._values = []
+        self._by_key = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, key, value: float):
+        self.remove(key)
+        insort(self._values, value)
+        self._by_key[key] = value
+
+    def remove(self, key):
+        value = self._by_key.pop(key, None)
+        if value is not None:
+            del self._values[bisect_left(self._values, value)]
+
+    def _interpolate(self, start: int, stop: int, q: float):
+        """Квантиль q среза values[start:stop] без копирования среза"""
+        if stop <= start:
+            return None
+        position = start + q * (stop - start - 1)
+        lower = int(position)
+        upper = min(lower + 1, stop - 1)
+        return self._values[lower] + (self._values[upper] - self._values[lower]) * (position - lower)
+
+    def quantile(self, q: float):
+        return self._interpolate(0, len(self._values), q)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def trimmed_median(self, lower: float = 0.01, upper: float = 0.95):
+        """Медиана значений между квантилями lower и upper (включительно) - как обрезка выбросов в отчете"""
+        if not self._values:
+            return None
+        start = bisect_left(self._values, self.quantile(lower))
+        stop = bisect_right(self._values, self.quantile(upper))
+        return self._interpolate(start, stop, 0.5)
+
+
+@dataclass
+class LeadInfo:
+    manager_id: str
+    created: datetime
+    taken: datetime = None
+    closed: bool = False
+    reaction_seconds: float = None
+    # Срок, после которого ожидающий лид считается просроченным
+    deadline: datetime = None
+    alerted: bool = False
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _is_closed(record: dict) -> bool:
+    semantic = record.get('STATUS_SEMANTIC_ID')
+    return semantic in FINAL_STATUS_SEMANTICS if semantic else record.get('STATUS_ID') in FINAL_STATUSES
+
+
+class LeadMonitor:
+    """
+    Скользящие показатели времени реакции и алерты по лидам без реакции
+
+    Args:
+        threshold_seconds: float - рабочее время без реакции, после которого лид считается просроченным
+        window: timedelta - за какой период (по времени создания лида) считаются показатели
+        holidays: iterable - нерабочие дни
+        on_alert: функция (alerts: list of (lead_id, LeadInfo, waited: timedelta)) - вызывается в check_alerts
+            со всеми лидами, просроченными к этому моменту; каждый лид попадает в алерт один раз
+        alerts_from: datetime - сроки раньше этого момента не алертятся (по умолчанию - время создания монитора)
+    """
+
+    def __init__(self, threshold_seconds: float = REACTION_ALERT_SECONDS, window: timedelta = timedelta(hours=24),
+                 holidays=None, on_alert=None, alerts_from: datetime = None):
+        self.threshold = timedelta(seconds=threshold_seconds)
+        self.window = window
+        self.holidays = holidays
+        self.on_alert = on_alert
+        self.alerts_from = alerts_from or datetime.now().astimezone()
+        self.department = SortedWindow()
+        self.managers = {}
+        self.leads = {}
+        self.watermark = None
+        self._deadlines = []
+        self._created = []
+
+    def _forget(self, lead_id):
+        """Убирает значение лида из показателей (перед обновлением или при выходе из окна)"""
+        previous = self.leads.get(lead_id)
+        if previous is not None and previous.reaction_seconds is not None:
+            self.department.remove(lead_id)
+            manager_window = self.managers.get(previous.manager_id)
+            if manager_window is not None:
+                manager_window.remove(lead_id)
+        return previous
+
+    def handle_lead(self, record: dict):
+        """Применяет новое состояние лида из CRM (поля LEAD_SELECT)"""
+        lead_id = int(record['ID'])
+        created = _parse_datetime(record['DATE_CREATE'])
+        taken = _parse_datetime(record.get('UF_CRM_1745414446'))
+        previous = self._forget(lead_id)
+
+        lead = LeadInfo(manager_id=record.get('ASSIGNED_BY_ID'), created=created, taken=taken,
+                        closed=_is_closed(record), alerted=previous.alerted if previous else False)
+        if taken is not None:
+            lead.reaction_seconds = calculate_working_hours(created, taken, holidays=self.holidays).total_seconds()
+            self.department.add(lead_id, lead.reaction_seconds)
+            self.managers.setdefault(lead.manager_id, SortedWindow()).add(lead_id, lead.reaction_seconds)
+        elif not lead.closed:
+            lead.deadline = previous.deadline if previous and previous.deadline else \
+                add_working_hours(created, self.threshold, holidays=self.holidays)
+            if not previous or previous.deadline is None:
+                heapq.heappush(self._deadlines, (lead.deadline, lead_id))
+        if previous is None:
+            heapq.heappush(self._created, (created, lead_id))
+        self.leads[lead_id] = lead
+
+    def expire(self, now: datetime):
+        """Убирает из показателей лиды, созданные раньше начала окна"""
+        window_start = now - self.window
+        while self._created and self._created[0][0] < window_start:
+            _, lead_id = heapq.heappop(self._created)
+            self._forget(lead_id)
+            self.leads.pop(lead_id, None)
+
+    def check_alerts(self, now: datetime) -> list:
+        """
+        Лиды, которые к моменту now ждут реакции дольше порога, - одним вызовом on_alert
+
+        Лиды считаются оповещенными только после успешного on_alert: если он упал (Telegram, user.get),
+        их сроки возвращаются в кучу, и алерт повторится при следующей проверке.
+
+        Returns:
+            list of (lead_id, LeadInfo, waited: timedelta)
+        """
+        alerts, popped = [], []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, lead_id = heapq.heappop(self._deadlines)
+            lead = self.leads.get(lead_id)
+            if lead is None or lead.taken is not None or lead.closed or lead.alerted:
+                continue
+            # Срок прошел до запуска монитора: по такому лиду алерт уже был (или его уже поздно слать)
+            if deadline < self.alerts_from:
+                lead.alerted = True
+                continue
+            waited = calculate_working_hours(lead.created, now.astimezone(lead.created.tzinfo), holidays=self.holidays)
+            alerts.append((lead_id, lead, waited))
+            popped.append((deadline, lead_id))
+        if alerts and self.on_alert:
+            try:
+                self.on_alert(alerts)
+            except Exception:
+                for item in popped:
+                    heapq.heappush(self._deadlines, item)
+                raise
+        for _, lead, _ in alerts:
+            lead.alerted = True
+        return alerts
+
+    def poll(self, client, window_start: datetime) -> int:
+        """Выгружает лиды, измененные с прошлого опроса, и применяет их. Возвращает количество лидов"""
+        # Watermark - время начала опроса с запасом, а не максимальный DATE_MODIFY: iter_list идет по ID,
+        # и лид с меньшим ID, измененный после того, как курсор его прошел, иначе потерялся бы (как в CrmStore.sync)
+        started = datetime.now().astimezone()
+        b24_filter = {'>=DATE_CREATE': window_start.isoformat(timespec='seconds')}
+        if self.watermark:
+            # >= а не >: лиды, измененные в ту же секунду, что и водяной знак, применяются повторно - это безопасно
+            b24_filter['>=DATE_MODIFY'] = self.watermark
+        count = 0
+        for chunk in client.iter_list('crm.lead.list', b24_filter=b24_filter,
+                                      select=LEAD_SELECT + ['STATUS_SEMANTIC_ID', 'DATE_MODIFY'], chunk_size=500):
+            for record in chunk:
+                self.handle_lead(record)
+            count += len(chunk)
+        self.watermark = (started - SYNC_OVERLAP).isoformat(timespec='seconds')
+        METRICS.add_rows('monitor:leads', count)
+        return count
+
+    def snapshot(self) -> dict:
+        """Текущие показатели: медиана отдела с обрезкой, медианы менеджеров, количество ожидающих лидов"""
+        def as_timedelta(seconds):
+            return None if seconds is None else timedelta(seconds=seconds)
+
+        return {
+            'leads': len(self.leads),
+            'pending': sum(1 for lead in self.leads.values() if lead.taken is None and not lead.closed),
+            'department_median': as_timedelta(self.department.trimmed_median()),
+            'managers': {manager_id: {'leads_with_time': len(window), 'median': as_timedelta(window.median())}
+                         for manager_id, window in self.managers.items() if len(window)},
+        }
+
+
+def main(argv=None):
+    from b24 import B24
+    from pipeline import ReportConfig
+    from reference_cache import ReferenceCache
+    from report import USER_SELECT, prepare_users
+    from telegram_delivery import TELEGRAM_API, TelegramSender
+
+    parser = argparse.ArgumentParser(description='Мониторинг времени реакции на лиды с алертами в Telegram')
+    parser.add_argument('--interval', type=float, default=60, help='период опроса CRM в секундах')
+    parser.add_argument('--window-hours', type=float, default=24, help='окно показателей по времени создания лида')
+    parser.add_argument('--threshold-minutes', type=float, default=REACTION_ALERT_SECONDS / 60,
+                        help='рабочее время без реакции до алерта')
+    parser.add_argument('--dry-run', action='store_true', help='печатать алерты вместо отправки в Telegram')
+    args = parser.parse_args(argv)
+
+    config = ReportConfig.from_env()
+    b24_leads = B24(config.domain, config.user_id, config.token_leads, base_url=config.b24_base_url)
+    b24_users = B24(config.domain, config.user_id, config.token_users, base_url=config.b24_base_url)
+    reference_cache = ReferenceCache(config.cache_dir)
+    telegram = None if args.dry_run else \
+        TelegramSender(config.telegram_token, api_url=config.telegram_api_url or TELEGRAM_API)
+
+    def on_alert(alerts: list):
+        manager_ids = {lead.manager_id for _, lead, _ in alerts}
+        items_users = reference_cache.get_list(b24_users, 'user.get', select=USER_SELECT, required_ids=manager_ids)
+        names = prepare_users(items_users).set_index('ID')['FULL_NAME']
+        lines = [f"⏰ Лид <a href='{config.crm_url}/crm/lead/details/{lead_id}/'>#{lead_id}</a> "
+                 f"без реакции уже <b>{format_time_no_microseconds(waited)}</b>, "
+                 f"👤 {names.get(int(lead.manager_id), lead.manager_id) if lead.manager_id else 'N/A'}"
+                 for lead_id, lead, waited in alerts]
+        # Все просроченные лиды - одним сообщением (или несколькими, если не влезают в лимит Telegram),
+        # чтобы лимит бота на сообщения в чат не задерживал следующий опрос
+        messages = [lines[0]]
+        for line in lines[1:]:
+            if len(messages[-1]) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+                messages.append(line)
+            else:
+                messages[-1] += '\n' + line
+        for text in messages:
+            if telegram is None:
+                print(text)
+            else:
+                telegram.send_message(text, config.chat_ids)
+
+    monitor = LeadMonitor(threshold_seconds=args.threshold_minutes * 60, window=timedelta(hours=args.window_hours),
+                          holidays=config.holidays, on_alert=on_alert)
+    backoff = args.interval
+    while True:
+        now = datetime.now().astimezone()
+        try:
+            with METRICS.timer('monitor:poll'):
+                changed = monitor.poll(b24_leads, now - monitor.window)
+            monitor.expire(now)
+            monitor.check_alerts(now)
+        except Exception as error:
+            # Сеть, лимиты или ошибка портала - монитор не падает, а повторяет опрос с растущей паузой
+            backoff = min(backoff * 2, max(MAX_ERROR_BACKOFF, args.interval))
+            print(f'[Ошибка] Опрос {now:%H:%M:%S}: {type(error).__name__}: {error}. '
+                  f'Следующая попытка через {backoff:.0f} с')
+            time.sleep(backoff)
+            continue
+        backoff = args.interval
+
+        snapshot = monitor.snapshot()
+        print(f"{now:%H:%M:%S} изменено лидов: {changed}, в окне: {snapshot['leads']}, "
+              f"ждут реакции: {snapshot['pending']}, "
+              f"медиана отдела: {format_time_no_microseconds(snapshot['department_median'])}")
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""
+Ежедневный отчет по лидам как цепочка стадий: fetch -> compute -> render -> export -> deliver
+
+Тяжелые библиотеки (pandas, matplotlib/seaborn, openpyxl, aiohttp) импортируются внутри
+стадий, поэтому, например, текстовая сводка без графика и Excel не загружает matplotlib.
+"""
+import asyncio
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from metrics import METRICS
+
+STAGES = ('fetch', 'compute', 'render', 'export', 'deliver')
+# Какие стадии нужны для каждой стадии
+STAGE_DEPENDENCIES = {
+    'fetch': (),
+    'compute': ('fetch',),
+    'render': ('compute',),
+    'export': ('compute',),
+    'deliver': ('compute',),
+}
+
+DEFAULT_CHAT_IDS = [727013047, 718885452, 6775209607, 1139941966, 332270956]
+
+
+def _env_list(name: str) -> list:
+    return [item.strip() for item in os.getenv(name, '').split(',') if item.strip()]
+
+
+@dataclass
+class ReportConfig:
+    """Настройки одного отчета. from_env() собирает их из переменных окружения"""
+    domain: str
+    user_id: int
+    token_leads: str
+    token_users: str
+    token_status: str
+    report_date: str
+    telegram_token: str = None
+    chat_ids: list = field(default_factory=lambda: list(DEFAULT_CHAT_IDS))
+    crm_url: str = None
+    category_id: int = 0
+    # Праздничные дни, которые не считаются рабочими
+    holidays: list = field(default_factory=list)
+    # Справочники менеджеров и стадий берем из локального кэша (cache_refresh - выгрузить заново)
+    cache_dir: str = '.b24_cache'
+    cache_refresh: bool = False
+    # Если задан store_path, лиды и сделки читаются из локального хранилища SQLite,
+    # которое перед отчетом догружается только измененными записями (по DATE_MODIFY).
+    # store_since - с какой даты брать записи при первой синхронизации
+    store_path: str = None
+    store_since: str = None
+    # Дополнительные условия к фильтрам лидов и сделок (например, отдел или источник)
+    extra_lead_filter: dict = field(default_factory=dict)
+    extra_deal_filter: dict = field(default_factory=dict)
+    render_preset: str = 'telegram'
+    detail_format: str = 'xlsx'
+    # Адреса API вместо https://{domain} и api.telegram.org (прокси, локальный тестовый сервер)
+    b24_base_url: str = None
+    telegram_api_url: str = None
+    # Куда сохранить метрики запуска: JSON и текстовый формат Prometheus (textfile collector)
+    metrics_path: str = None
+    prometheus_path: str = None
+
+    @classmethod
+    def from_env(cls, report_date: str = None) -> 'ReportConfig':
+        """
+        Переменные: B24_DOMAIN, B24_USER_ID, B24_TOKEN_LEADS, B24_TOKEN_USERS, B24_TOKEN_STATUS,
+        TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_IDS, B24_CRM_URL, WORK_HOLIDAYS, B24_CACHE_DIR, B24_CACHE_REFRESH,
+        CRM_STORE_PATH, CRM_STORE_SINCE, REPORT_RENDER_PRESET, REPORT_DETAIL_FORMAT,
+        REPORT_METRICS_PATH, REPORT_PROMETHEUS_PATH, B24_BASE_URL, TELEGRAM_API_URL.
+        По умолчанию отчетный день - вчера
+        """
+        chat_ids = [int(chat_id) for chat_id in _env_list('TELEGRAM_CHAT_IDS')] or list(DEFAULT_CHAT_IDS)
+        return cls(
+            domain=os.getenv('B24_DOMAIN'),
+            user_id=int(os.getenv('B24_USER_ID')),
+            token_leads=os.getenv('B24_TOKEN_LEADS'),
+            token_users=os.getenv('B24_TOKEN_USERS'),
+            token_status=os.getenv('B24_TOKEN_STATUS'),
+            report_date=report_date or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d'),
+            telegram_token=os.getenv('TELEGRAM_BOT_TOKEN'),
+            chat_ids=chat_ids,
+            crm_url=os.getenv('B24_CRM_URL'),
+            holidays=_env_list('WORK_HOLIDAYS'),
+            cache_dir=os.getenv('B24_CACHE_DIR', '.b24_cache'),
+            cache_refresh=os.getenv('B24_CACHE_REFRESH') == '1',
+            store_path=os.getenv('CRM_STORE_PATH'),
+            store_since=os.getenv('CRM_STORE_SINCE'),
+            render_preset=os.getenv('REPORT_RENDER_PRESET', 'telegram'),
+            detail_format=os.getenv('REPORT_DETAIL_FORMAT', 'xlsx'),
+            metrics_path=os.getenv('REPORT_METRICS_PATH'),
+            prometheus_path=os.getenv('REPORT_PROMETHEUS_PATH'),
+            b24_base_url=os.getenv('B24_BASE_URL'),
+            telegram_api_url=os.getenv('TELEGRAM_API_URL'),
+        )
+
+
+@dataclass
+class ReportState:
+    """Результаты стадий: каждая стадия читает то, что положили предыдущие"""
+    config: ReportConfig
+    leads: list = None
+    deals: list = None
+    items_users: list = None
+    status_list: list = None
+    computed: dict = None
+    message: str = None
+    image: tuple = None
+    detail: tuple = None
+    # Общий TelegramSender (лимиты на чат и на бота), если отчетов несколько; иначе deliver создает свой
+    telegram: object = None
+
+
+def resolve_stages(stages) -> list:
+    """Добавляет к запрошенным стадиям те, от которых они зависят, и упорядочивает их"""
+    resolved = set()
+
+    def add(stage):
+        if stage not in STAGE_DEPENDENCIES:
+            raise ValueError(f'Неизвестная стадия {stage}, доступны: {", ".join(STAGES)}')
+        if stage not in resolved:
+            resolved.add(stage)
+            for dependency in STAGE_DEPENDENCIES[stage]:
+                add(dependency)
+
+    for stage in stages:
+        add(stage)
+    return [stage for stage in STAGES if stage in resolved]
+
+
+def report_filters(config: ReportConfig):
+    """Фильтры лидов и сделок отчета: отчетный день, воронка и дополнительные условия из настроек"""
+    from report import lead_filter, deal_filter
+
+    return ({**lead_filter(config.report_date), **config.extra_lead_filter},
+            {**deal_filter(config.report_date, config.category_id), **config.extra_deal_filter})
+
+
+def sync_store(config: ReportConfig, limiter=None, filters: list = None):
+    """
+    Догружает в локальное хранилище лиды и сделки, измененные с прошлой синхронизации,
+    и убирает из окна отчета записи, удаленные в Bitrix24
+
+    Args:
+        filters: list of (leads_filter, deals_filter) - окна всех отчетов, которые читают это хранилище
+            (по умолчанию - только отчет config); хранятся поля всех их условий
+    """
+    from b24 import B24
+    from crm_store import CrmStore, filter_fields
+    from report import LEAD_SELECT, DEAL_SELECT
+
+    filters = filters or [report_filters(config)]
+    store = CrmStore(config.store_path)
+    b24 = B24(config.domain, config.user_id, config.token_leads, limiter=limiter, base_url=config.b24_base_url)
+    # Поля дополнительных условий тоже храним, иначе по ним не отфильтровать
+    leads_select = list(dict.fromkeys(LEAD_SELECT + [field for leads_filter, _ in filters
+                                                     for field in filter_fields(leads_filter)]))
+    deals_select = list(dict.fromkeys(DEAL_SELECT + [field for _, deals_filter in filters
+                                                     for field in filter_fields(deals_filter)]))
+    store.sync(b24, 'leads', 'crm.lead.list', select=leads_select, initial_since=config.store_since)
+    # Сделки синхронизируем без фильтра по стадии, чтобы подтянуть и выход сделки из WON
+    store.sync(b24, 'deals', 'crm.deal.list', select=deals_select, initial_since=config.store_since)
+    windows = []
+    for pair in filters:
+        if pair not in windows:
+            windows.append(pair)
+    for leads_filter, deals_filter in windows:
+        store.reconcile(b24, 'leads', 'crm.lead.list', leads_select, leads_filter)
+        store.reconcile(b24, 'deals', 'crm.deal.list', deals_select, deals_filter)
+
+
+def read_store(config: ReportConfig):
+    """Лиды и сделки отчета из локального хранилища, без запросов к API"""
+    from crm_store import CrmStore
+    from report import LEAD_SELECT, DEAL_SELECT
+
+    leads_filter, deals_filter = report_filters(config)
+    store = CrmStore(config.store_path)
+    return (store.select('leads', leads_filter, columns=LEAD_SELECT),
+            store.select('deals', deals_filter, columns=DEAL_SELECT))
+
+
+def _fetch_from_store(config: ReportConfig, limiter=None):
+    """Синхронизирует локальное хранилище лидов и сделок и читает из него данные за отчетный день"""
+    sync_store(config, limiter)
+    return read_store(config)
+
+
+async def fetch_crm_data(config: ReportConfig, b24_leads):
+    """Лиды и сделки отчета: из локального хранилища (config.store_path) или напрямую из СRM"""
+    from report import LEAD_SELECT, DEAL_SELECT
+
+    if config.store_path:
+        return await asyncio.to_thread(_fetch_from_store, config, b24_leads.limiter)
+    leads_filter, deals_filter = report_filters(config)
+    return await asyncio.gather(
+        b24_leads.get_list('crm.lead.list', b24_filter=leads_filter, select=LEAD_SELECT, batch=True),
+        b24_leads.get_list("crm.deal.list", b24_filter=deals_filter, select=DEAL_SELECT, batch=True),
+    )
+
+
+async def fetch_references(reference_cache, b24_users, b24_status, leads: list = None, refresh: bool = False):
+    """
+    Справочники менеджеров и стадий из кэша
+
+    Если в leads есть менеджер или стадия, которых нет в кэше, справочник выгружается заново
+    """
+    from report import USER_SELECT, STATUS_SELECT
+
+    return await asyncio.gather(
+        reference_cache.aget_list(b24_users, 'user.get', select=USER_SELECT, refresh=refresh,
+                                  required_ids={lead['ASSIGNED_BY_ID'] for lead in leads} if leads else None),
+        reference_cache.aget_list(b24_status, 'crm.status.list', select=STATUS_SELECT, refresh=refresh,
+                                  required_ids={lead['STATUS_ID'] for lead in leads} if leads else None,
+                                  id_field='STATUS_ID'),
+    )
+
+
+async def fetch_all(config: ReportConfig):
+    """
+    Выгружает лиды, сделки, менеджеров и стадии из СRM одновременно
+
+    Все клиенты работают через один пул соединений, но у каждого токена свой лимитер,
+    поэтому время выгрузки равно самой долгой из четырех выгрузок, а не их сумме
+    """
+    from b24_async import AsyncB24, make_async_session
+    from reference_cache import ReferenceCache
+
+    reference_cache = ReferenceCache(config.cache_dir)
+    async with make_async_session() as session:
+        b24_leads = AsyncB24(config.domain, config.user_id, config.token_leads, session=session,
+                             base_url=config.b24_base_url)
+        b24_users = AsyncB24(config.domain, config.user_id, config.token_users, session=session,
+                             base_url=config.b24_base_url)
+        b24_status = AsyncB24(config.domain, config.user_id, config.token_status, session=session,
+                              base_url=config.b24_base_url)
+        (leads, deals), _ = await asyncio.gather(
+            fetch_crm_data(config, b24_leads),
+            fetch_references(reference_cache, b24_users, b24_status, refresh=config.cache_refresh),
+        )
+        items_users, status_list = await fetch_references(reference_cache, b24_users, b24_status, leads)
+        return leads, deals, items_users, status_list
+
+
+def fetch(state: ReportState):
+    #Выгружаем данные по лидам, сделкам, менеджерам и стадиям из СRM
+    state.leads, state.deals, state.items_users, state.status_list = asyncio.run(fetch_all(state.config))
+    for dataset in ('leads', 'deals', 'items_users', 'status_list'):
+        METRICS.add_rows(f'fetch:{dataset}', len(getattr(state, dataset)))
+
+
+def compute(state: ReportState):
+    from report import prepare_leads, prepare_deals, prepare_users, prepare_statuses, aggregate_report, join_leads, \
+        build_message
+
+    leads_df = prepare_leads(state.leads, holidays=state.config.holidays)
+    deals_df = prepare_deals(state.deals)
+    users_df = prepare_users(state.items_users)
+    df_status = prepare_statuses(state.status_list)
+    METRICS.add_rows('compute:leads', len(leads_df))
+
+    #Считаю конверсии с учетом рабочего времени
+    # ДЛЯ ОТДЕЛА: с обрезкой выбросов 1%-95%
+    # ДЛЯ МЕНЕДЖЕРОВ: без обрезки
+    full_agg_data, median_reaction = aggregate_report(leads_df, deals_df, users_df)
+
+    state.computed = {
+        'leads_df': leads_df,
+        'users_df': users_df,
+        'full_agg_data': full_agg_data,
+        'median_reaction': median_reaction,
+        #Объединям данные
+        'full_data': join_leads(leads_df, users_df, df_status),
+    }
+    state.message = build_message(state.config.report_date, len(leads_df), median_reaction, full_agg_data)
+
+
+def render(state: ReportState):
+    # Рисуем дашборд в память
+    from render import render_report_figure, render_to_buffer
+
+    figure = render_report_figure(state.computed['full_data'], state.config.report_date)
+    state.image = render_to_buffer(figure, state.config.render_preset)
+
+
+def export(state: ReportState):
+    # Готовим детальный отчет по лидам в памяти
+    from export import build_detail_frame, export_detail
+
+    frame = build_detail_frame(state.computed['leads_df'], state.computed['users_df'], state.config.crm_url)
+    state.detail = export_detail(frame, f'leads_detail_{state.config.report_date}', state.config.detail_format)
+    METRICS.add_rows('export:detail', len(frame))
+    print(f"Детальный отчет подготовлен: {state.detail[1]}")
+
+
+def deliver(state: ReportState):
+    #Отправляем данные в телеграм бота
+    from telegram_delivery import TELEGRAM_API, TelegramSender
+
+    config = state.config
+    telegram = state.telegram or TelegramSender(config.telegram_token, api_url=config.telegram_api_url or TELEGRAM_API)
+    if state.image:
+        buffer, filename = state.image
+        telegram.send_photo(buffer.getvalue(), config.chat_ids, filename=filename)
+    telegram.send_message(state.message, config.chat_ids)
+    if state.detail:
+        buffer, filename = state.detail
+        telegram.send_document(buffer.getvalue(), config.chat_ids, filename=filename)
+
+
+STAGE_FUNCTIONS = {
+    'fetch': fetch,
+    'compute': compute,
+    'render': render,
+    'export': export,
+    'deliver': deliver,
+}
+
+
+def run_stages(state: ReportState, stages, label: str = None) -> ReportState:
+    """
+    Выполняет стадии по порядку над готовым state, без добавления зависимостей - так можно
+    продолжить отчет, данные которого уже выгружены. Время стадий пишется в METRICS
+    """
+    prefix = f'{label}:' if label else ''
+    for stage in stages:
+        with METRICS.timer(f'{prefix}stage:{stage}'):
+            STAGE_FUNCTIONS[stage](state)
+    return state
+
+
+def run_report(config: ReportConfig, stages=STAGES) -> ReportState:
+    """
+    Выполняет стадии отчета (с учетом зависимостей) и возвращает их результаты
+
+    В конце запуска (в том числе неудачного) метрики печатаются строкой JSON и сохраняются
+    в config.metrics_path / config.prometheus_path
+    """
+    METRICS.reset()
+    try:
+        return run_stages(ReportState(config=config), resolve_stages(stages))
+    finally:
+        METRICS.emit(config.metrics_path, config.prometheus_path)
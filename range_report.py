@@ -0,0 +1,169 @@
+"""
+Отчет по лидам за произвольный период
+
+Считает те же показатели, что и ежедневный отчет (количество лидов, CR%, медиана
+времени реакции, распределение по стадиям), для каждого дня периода и в целом за период.
+Дни выгружаются и считаются параллельно, общий лимитер каждого токена не дает превысить
+лимиты Bitrix24. Итог сохраняется в Excel.
+
+Пример:
+    python range_report.py 2025-01-01 2025-03-31 --workers 8 --out leads_2025Q1.xlsx
+"""
+import argparse
+import asyncio
+from datetime import date, timedelta
+
+import pandas as pd
+
+from b24_async import AsyncB24, make_async_session
+from metrics import METRICS
+from pipeline import ReportConfig
+from reference_cache import ReferenceCache
+from report import (LEAD_SELECT, DEAL_SELECT, USER_SELECT, STATUS_SELECT, lead_filter, deal_filter, prepare_leads,
+                    concat_leads, prepare_deals, prepare_users, prepare_statuses, aggregate_report, join_leads,
+                    format_time_no_microseconds)
+
+
+def day_range(start: str, end: str) -> list:
+    """Список дней YYYY-MM-DD от start до end включительно"""
+    first, last = date.fromisoformat(start), date.fromisoformat(end)
+    if last < first:
+        raise ValueError(f'Конец периода {end} раньше начала {start}')
+    return [(first + timedelta(days=i)).isoformat() for i in range((last - first).days + 1)]
+
+
+def summarize(leads_df: pd.DataFrame, deals_df: pd.DataFrame, users_df: pd.DataFrame, df_status: pd.DataFrame):
+    """
+    Показатели отчета по набору лидов и сделок
+
+    Returns:
+        (summary, managers, statuses) - dict итогов по отделу, DataFrame по менеджерам,
+        Series количества лидов по стадиям
+    """
+    managers, median_reaction = aggregate_report(leads_df, deals_df, users_df)
+    statuses = join_leads(leads_df, users_df, df_status)['status_lead'].value_counts()
+
+    number_of_leads, number_of_deals = len(leads_df), len(deals_df)
+    summary = {
+        'number_of_leads': number_of_leads,
+        'number_of_deals': number_of_deals,
+        'CR%': round(number_of_deals / number_of_leads * 100, 2) if number_of_leads else 0.0,
+        'median_reaction': median_reaction,
+    }
+    return summary, managers, statuses
+
+
+async def _fetch_day(b24_leads: AsyncB24, day: str, category_id: int, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        return await asyncio.gather(
+            b24_leads.get_list('crm.lead.list', b24_filter=lead_filter(day), select=LEAD_SELECT, batch=True),
+            b24_leads.get_list('crm.deal.list', b24_filter=deal_filter(day, category_id), select=DEAL_SELECT, batch=True),
+        )
+
+
+async def run_range(days: list, b24_leads: AsyncB24, b24_users: AsyncB24, b24_status: AsyncB24,
+                    reference_cache: ReferenceCache, category_id: int = 0, workers: int = 4, holidays=None):
+    """
+    Выгружает и считает отчет по каждому дню из days параллельно
+
+    Одновременно выгружается не больше workers дней, подсчет дня выполняется в отдельном
+    потоке сразу после его выгрузки, пока выгружаются следующие дни.
+
+    Returns:
+        dict - daily (итоги по дням), daily_managers, daily_statuses, total (итог за период), total_managers
+    """
+    items_users, status_list = await asyncio.gather(
+        reference_cache.aget_list(b24_users, 'user.get', select=USER_SELECT),
+        reference_cache.aget_list(b24_status, 'crm.status.list', select=STATUS_SELECT),
+    )
+    users_df = prepare_users(items_users)
+    df_status = prepare_statuses(status_list)
+    semaphore = asyncio.Semaphore(workers)
+
+    async def process_day(day):
+        leads, deals = await _fetch_day(b24_leads, day, category_id, semaphore)
+
+        def compute():
+            leads_df = prepare_leads(leads, holidays=holidays)
+            deals_df = prepare_deals(deals)
+            return leads_df, deals_df, summarize(leads_df, deals_df, users_df, df_status)
+
+        return day, await asyncio.to_thread(compute)
+
+    results = await asyncio.gather(*(process_day(day) for day in days))
+
+    daily, daily_managers, daily_statuses = [], [], {}
+    all_leads, all_deals = [], []
+    for day, (leads_df, deals_df, (summary, managers, statuses)) in results:
+        daily.append({'date': day, **summary})
+        daily_managers.append(managers.assign(date=day))
+        daily_statuses[day] = statuses
+        all_leads.append(leads_df)
+        all_deals.append(deals_df)
+
+    # Итог за период считается по всем лидам сразу, а не усреднением дневных медиан
+    total_leads = concat_leads(all_leads)
+    total_deals = pd.concat(all_deals, ignore_index=True)
+    total, total_managers, total_statuses = summarize(total_leads, total_deals, users_df, df_status)
+
+    return {
+        'daily': pd.DataFrame(daily),
+        'daily_managers': pd.concat(daily_managers, ignore_index=True)[['date', 'FULL_NAME', 'CR%', 'time_taken_in_work']],
+        'daily_statuses': pd.DataFrame(daily_statuses).T.fillna(0).astype(int).rename_axis('date').reset_index(),
+        'total': pd.DataFrame([{'period': f'{days[0]} — {days[-1]}', **total}]),
+        'total_managers': total_managers,
+        'total_statuses': total_statuses.rename_axis('status_lead').reset_index(name='number_of_leads'),
+    }
+
+
+def save_excel(result: dict, filename: str):
+    """Сохраняет результат run_range в Excel, время реакции в формате ЧЧ:ММ:СС"""
+    sheets = {
+        'По дням': result['daily'],
+        'Менеджеры по дням': result['daily_managers'],
+        'Стадии по дням': result['daily_statuses'],
+        'Итого': result['total'],
+        'Менеджеры итого': result['total_managers'],
+        'Стадии итого': result['total_statuses'],
+    }
+    with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+        for name, sheet in sheets.items():
+            sheet = sheet.copy()
+            for col in ('median_reaction', 'time_taken_in_work'):
+                if col in sheet:
+                    sheet[col] = sheet[col].map(format_time_no_microseconds)
+            sheet.to_excel(writer, sheet_name=name, index=False)
+
+
+async def main(args):
+    config = ReportConfig.from_env()
+    reference_cache = ReferenceCache(config.cache_dir)
+
+    async with make_async_session() as session:
+        b24_leads = AsyncB24(config.domain, config.user_id, config.token_leads, session=session,
+                             base_url=config.b24_base_url)
+        b24_users = AsyncB24(config.domain, config.user_id, config.token_users, session=session,
+                             base_url=config.b24_base_url)
+        b24_status = AsyncB24(config.domain, config.user_id, config.token_status, session=session,
+                              base_url=config.b24_base_url)
+        with METRICS.timer('range:fetch_compute'):
+            result = await run_range(day_range(args.start, args.end), b24_leads, b24_users, b24_status,
+                                     reference_cache, category_id=args.category_id, workers=args.workers,
+                                     holidays=config.holidays)
+
+    out = args.out or f'leads_range_{args.start}_{args.end}.xlsx'
+    with METRICS.timer('range:excel'):
+        save_excel(result, out)
+    print(result['total'].to_string(index=False))
+    print(f"Excel файл сохранен: {out}")
+    METRICS.emit(config.metrics_path, config.prometheus_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Отчет по лидам за период: по дням и итог')
+    parser.add_argument('start', help='первый день периода, YYYY-MM-DD')
+    parser.add_argument('end', help='последний день периода, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, default=4, help='сколько дней выгружать одновременно')
+    parser.add_argument('--category-id', type=int, default=0, help='воронка сделок')
+    parser.add_argument('--out', help='имя Excel файла')
+    asyncio.run(main(parser.parse_args()))
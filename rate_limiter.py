@@ -0,0 +1,72 @@
+import random
+import threading
+import time
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Экспоненциальная задержка с полным джиттером: случайное значение от 0 до min(cap, base * 2^attempt)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Token bucket под лимиты REST API Bitrix24
+
+    Bitrix24 разрешает `rate` запросов в секунду с накоплением до `burst` запросов,
+    а также ограничивает суммарное время выполнения (operating) каждого метода
+    за 10 минут. Время operating портал сам возвращает в ключе `time` каждого ответа,
+    поэтому лимитер не считает его, а запоминает последнее значение по методу.
+
+    Args:
+        rate: float - сколько запросов в секунду пополняется в ведро
+        burst: int - емкость ведра
+        operating_limit: float - порог operating (в секундах), после которого метод ждет operating_reset_at
+    """
+
+    def __init__(self, rate: float = 2.0, burst: int = 50, operating_limit: float = 480.0):
+        self.rate = rate
+        self.burst = burst
+        self.operating_limit = operating_limit
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._operating = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, method: str = None) -> float:
+        """Резервирует один запрос и возвращает, сколько секунд нужно подождать перед его отправкой"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Токены могут уйти в минус - это очередь уже зарезервированных запросов
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+
+            if method in self._operating:
+                operating, reset_at = self._operating[method]
+                until_reset = reset_at - time.time()
+                if until_reset <= 0:
+                    del self._operating[method]
+                elif operating >= self.operating_limit:
+                    wait = max(wait, until_reset)
+            return wait
+
+    def acquire(self, method: str = None) -> float:
+        """Блокирует поток, пока запрос не уложится в лимит. Возвращает время ожидания"""
+        wait = self.reserve(method)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def update_operating(self, method: str, time_info: dict):
+        """Запоминает operating и operating_reset_at из ключа `time` ответа Bitrix24"""
+        if not time_info or 'operating' not in time_info:
+            return
+        reset_at = time_info.get('operating_reset_at') or time.time() + 600
+        with self._lock:
+            self._operating[method] = (float(time_info['operating']), float(reset_at))
+
+    def penalize(self, delay: float):
+        """После ответа о превышении лимита опустошает ведро, чтобы следующие запросы подождали delay секунд"""
+        with self._lock:
+            self._tokens = min(self._tokens, -delay * self.rate)
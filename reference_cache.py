@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import time
+
+# Время жизни кэша по умолчанию (в секундах) для справочных методов
+DEFAULT_TTL = {
+    'user.get': 6 * 3600,
+    'crm.status.list': 24 * 3600,
+}
+
+
+class ReferenceCache:
+    """
+    Локальный дисковый кэш справочников Bitrix24 (user.get, crm.status.list)
+
+    Справочники меняются редко, а нужны только для подстановки имен менеджеров и стадий,
+    поэтому они берутся из файла, пока не истек TTL метода. Если в отчете встречается
+    ID, которого нет в кэше (новый менеджер или стадия), справочник выгружается заново.
+    ID, которых нет и в свежей выгрузке (удаленный или экстранет-пользователь), запоминаются
+    вместе с записями и до истечения TTL повторной выгрузки не вызывают.
+
+    Args:
+        cache_dir: str - папка для файлов кэша
+        ttl: dict - TTL в секундах по методам, дополняет DEFAULT_TTL
+        default_ttl: int - TTL для методов, которых нет в ttl
+    """
+
+    def __init__(self, cache_dir: str = '.b24_cache', ttl: dict = None, default_ttl: int = 3600):
+        self.cache_dir = cache_dir
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self.default_ttl = default_ttl
+
+    def _path(self, domain: str, url: str, select: list = None, b24_filter: dict = None) -> str:
+        params = json.dumps({'select': select, 'filter': b24_filter}, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha1(params.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f'{domain}_{url}_{digest}.json')
+
+    def _load_entry(self, domain: str, url: str, select: list = None, b24_filter: dict = None):
+        path = self._path(domain, url, select, b24_filter)
+        try:
+            with open(path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cached['saved_at'] > self.ttl.get(url, self.default_ttl):
+            return None
+        return cached
+
+    def load(self, domain: str, url: str, select: list = None, b24_filter: dict = None):
+        """Возвращает записи из кэша или None, если кэша нет или истек TTL"""
+        cached = self._load_entry(domain, url, select, b24_filter)
+        return None if cached is None else cached['items']
+
+    def store(self, domain: str, url: str, items: list, select: list = None, b24_filter: dict = None,
+              missing_ids=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(domain, url, select, b24_filter)
+        # Пишем во временный файл и подменяем, чтобы параллельный запуск не прочитал половину файла
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': time.time(), 'items': items, 'missing_ids': sorted(missing_ids or [])}, f,
+                      ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, domain: str = None, url: str = None):
+        """Удаляет файлы кэша портала и/или метода (без аргументов - весь кэш)"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        prefix = f'{domain}_{url or ""}' if domain else ''
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and (url is None or f'_{url}_' in name):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _missing(items: list, required_ids, id_field: str) -> set:
+        cached_ids = {str(item.get(id_field)) for item in items}
+        return {str(value) for value in required_ids or () if value is not None} - cached_ids
+
+    def _cached(self, domain: str, url: str, select: list, b24_filter: dict, refresh: bool, required_ids,
+                id_field: str):
+        """
+        Returns:
+            (items, known_missing) - записи из кэша (None, если нужна выгрузка) и ID, которых не было в прошлой выгрузке
+        """
+        cached = None if refresh else self._load_entry(domain, url, select, b24_filter)
+        if cached is None:
+            return None, set()
+        known_missing = set(cached.get('missing_ids') or [])
+        missing = self._missing(cached['items'], required_ids, id_field) - known_missing
+        if missing:
+            print(f'В кэше нет {id_field}: {sorted(missing)[:10]}, обновляем справочник')
+            return None, known_missing
+        return cached['items'], known_missing
+
+    def _store_fetched(self, domain: str, url: str, items: list, select: list, b24_filter: dict, required_ids,
+                       id_field: str, known_missing: set):
+        # ID, которых нет и в свежей выгрузке, запоминаются, чтобы не выгружать справочник заново на каждом запуске
+        missing = self._missing(items, set(required_ids or ()) | known_missing, id_field)
+        if missing:
+            print(f'В справочнике {url} нет {id_field}: {sorted(missing)[:10]}')
+        self.store(domain, url, items, select, b24_filter, missing_ids=missing)
+
+    def get_list(self, client, url: str, select: list = None, b24_filter: dict = None, refresh: bool = False,
+                 required_ids=None, id_field: str = 'ID') -> list:
+        """
+        B24.get_list через кэш
+
+        Args:
+            client: B24 - клиент, которым выгружается справочник при промахе
+            refresh: bool - игнорировать кэш и выгрузить заново
+            required_ids: iterable - ID, которые должны быть в справочнике; если какого-то нет, кэш обновляется
+                (кроме ID, которых не было и в прошлой выгрузке)
+            id_field: str - поле записи, в котором лежит ID (ID для user.get, STATUS_ID для crm.status.list)
+        """
+        items, known_missing = self._cached(client.domain, url, select, b24_filter, refresh, required_ids, id_field)
+        if items is None:
+            items = client.get_list(url, b24_filter=b24_filter, select=select, batch=True)
+            self._store_fetched(client.domain, url, items, select, b24_filter, required_ids, id_field, known_missing)
+        return items
+
+    async def aget_list(self, client, url: str, select: list = None, b24_filter: dict = None, refresh: bool = False,
+                        required_ids=None, id_field: str = 'ID') -> list:
+        """То же, что get_list, для AsyncB24"""
+        items, known_missing = self._cached(client.domain, url, select, b24_filter, refresh, required_ids, id_field)
+        if items is None:
+            items = await client.get_list(url, b24_filter=b24_filter, select=select, batch=True)
+            self._store_fetched(client.domain, url, items, select, b24_filter, required_ids, id_field, known_missing)
+        return items
@@ -0,0 +1,112 @@
+import io
+
+import matplotlib
+
+# Неинтерактивный бэкенд: на сервере окна не нужны, plt.show() не блокирует и не тратит время
+matplotlib.use('Agg')
+
+import seaborn as sns  # noqa: E402
+from matplotlib.figure import Figure  # noqa: E402
+
+# Пресеты сохранения графика: формат, DPI и параметры Pillow.
+# Telegram все равно пережимает фото до ~2560px по большей стороне, поэтому 150 DPI ему хватает;
+# для плоских диаграмм PNG выходит не больше JPEG и без артефактов, WebP - самый легкий
+RENDER_PRESETS = {
+    'telegram': {'format': 'png', 'dpi': 150},
+    'jpeg': {'format': 'jpeg', 'dpi': 150, 'pil_kwargs': {'quality': 85}},
+    'webp': {'format': 'webp', 'dpi': 150, 'pil_kwargs': {'quality': 80}},
+    'print': {'format': 'png', 'dpi': 300},
+}
+
+
+def _barh_counts(ax, counts, title: str, ylabel: str):
+    """Горизонтальная диаграмма количества с подписями значений"""
+    counts.plot(kind='barh', ax=ax, color='skyblue', edgecolor='black')
+    ax.set_title(title, fontsize=14)
+    ax.set_xlabel('Количество', fontsize=12)
+    ax.set_ylabel(ylabel, fontsize=12)
+    ax.tick_params(axis='y', rotation=0, labelsize=10)  # Уменьшаем размер шрифта
+    ax.grid(axis='x', linestyle='--', alpha=0.7)
+    for p in ax.patches:
+        ax.annotate(f'{p.get_width():.0f}',
+                    (p.get_width(), p.get_y() + p.get_height() / 2.),
+                    ha='left', va='center', fontsize=12, color='black',
+                    xytext=(5, 0), textcoords='offset points')
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+
+
+def render_report_figure(full_data, report_date: str):
+    """
+    Строит дашборд 2x2 по лидам за день
+
+    Args:
+        full_data: DataFrame - лиды с колонками ID_lead, UTM_SOURCE, manager_name, status_lead (report.join_leads)
+        report_date: str - дата отчета для заголовка
+
+    Returns:
+        Figure
+    """
+    # Создаем фигуру с 2 строками и 2 столбцами. Figure без pyplot: у pyplot общее состояние,
+    # а так несколько отчетов могут рисоваться одновременно в разных потоках
+    fig = Figure(figsize=(14, 10))
+    axes = fig.subplots(2, 2)
+
+    # Добавляем общий заголовок с датой
+    fig.suptitle(f'Анализ данных по лидам {report_date}', fontsize=18, fontweight='bold')
+
+    # 1-й график: Распределение UTM_SOURCE
+    _barh_counts(axes[0, 0], full_data.UTM_SOURCE.value_counts(ascending=True),
+                 'Распределение UTM_SOURCE', 'Источник')
+
+    # 2-й график: Количество обработанных сделок в разрезе менеджера (горизонтальный)
+    _barh_counts(axes[0, 1], full_data.manager_name.value_counts(ascending=True),
+                 'Количество обработанных лидов в разрезе менеджера', 'Менеджер')
+
+    # 3-й график: Распределение лидов по стадиям (горизонтальный)
+    _barh_counts(axes[1, 0], full_data.status_lead.value_counts(ascending=True),
+                 'Распределение лидов по стадиям', 'Стадия')
+
+    # 4-й график: Heatmap распределения лидов по менеджерам и стадиям
+    stage_by_manager_data = full_data.pivot_table(index='manager_name',
+                         columns='status_lead',
+                         values='ID_lead',
+                         aggfunc='count',
+                         fill_value=0)
+
+    sns.heatmap(stage_by_manager_data,
+                annot=True,
+                fmt='d',
+                cmap='Blues',
+                cbar=False,
+                annot_kws={"size": 12, "weight": 'bold', "color": 'black'},
+                linewidths=0.5,
+                linecolor='gray',
+                square=True,
+                ax=axes[1, 1])  # Применяем heatmap на 4-й подграфик
+    axes[1, 1].set_title('Распределение лидов по менеджерам и стадиям', fontsize=16)
+    axes[1, 1].set_xlabel('Стадии лидов', fontsize=12)
+    axes[1, 1].set_ylabel('Менеджеры', fontsize=12)
+
+    for spine in axes[1, 1].spines.values():
+        spine.set_visible(False)
+
+    # Настройки для компоновки графиков
+    fig.subplots_adjust(hspace=0.3)  # Увеличиваем расстояние между строками
+    fig.tight_layout()  # Сжать графики для лучшего отображения
+    return fig
+
+
+def render_to_buffer(fig, preset: str = 'telegram'):
+    """
+    Сохраняет фигуру в память по пресету из RENDER_PRESETS
+
+    Returns:
+        (BytesIO, filename) - буфер с изображением и имя файла с нужным расширением
+    """
+    options = dict(RENDER_PRESETS[preset])
+    image_format = options.pop('format')
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=image_format, bbox_inches='tight', **options)
+    buffer.seek(0)
+    return buffer, f'leads_report.{"jpg" if image_format == "jpeg" else image_format}'
@@ -0,0 +1,198 @@
+
+import numpy as np
+import pandas as pd
+
+from metrics import METRICS
+from working_hours import calculate_working_hours_vectorized
+
+# Поля, которые выгружаются из СRM для отчета
+LEAD_SELECT = ['ID', 'STATUS_ID', 'ASSIGNED_BY_ID', 'DATE_CREATE', 'UTM_SOURCE', 'UF_CRM_1745414446']
+DEAL_SELECT = ["ID", "OPPORTUNITY", 'ASSIGNED_BY_ID', 'CLOSEDATE', 'UTM_SOURCE', 'UF_CRM_1695636781']
+USER_SELECT = ['ID', 'NAME', 'LAST_NAME', 'SECOND_NAME']
+STATUS_SELECT = ['ID', 'NAME']
+
+# Колонки лидов, которые хранятся как категории: мало уникальных значений на много строк
+LEAD_CATEGORIES = ('ASSIGNED_BY_ID', 'STATUS_ID', 'UTM_SOURCE')
+
+# Порог времени реакции, после которого в отчете ставится ⏰
+REACTION_ALERT_SECONDS = 20 * 60
+
+
+def lead_filter(day: str) -> dict:
+    """Фильтр лидов, созданных за день day (YYYY-MM-DD)"""
+    return {'>=DATE_CREATE': f'{day}T00:00:01', '<=DATE_CREATE': f'{day}T23:59:59'}
+
+
+def deal_filter(day: str, category_id: int = 0) -> dict:
+    """Фильтр выигранных сделок воронки category_id, закрытых за день day (YYYY-MM-DD)"""
+    return {
+        "CATEGORY_ID": category_id,
+        ">=CLOSEDATE": f'{day}T00:00:01',
+        "<=CLOSEDATE": f'{day}T23:59:59',
+        'STAGE_ID': 'WON'
+    }
+
+
+def _columns(records: list, fields: list) -> dict:
+    """Записи из СRM -> dict колонок, без промежуточного DataFrame из словарей"""
+    return {field: [record.get(field) for record in records] for field in fields}
+
+
+def _id_column(values) -> pd.Series:
+    """ID из СRM приходят строками: '123' -> Int64 (пустые -> <NA>)"""
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype('Int64')
+
+
+def _datetime_column(values: list) -> pd.Series:
+    """
+    Даты Bitrix24 ('2025-01-31T10:15:00+02:00') -> naive datetime по местному времени портала, пустые -> NaT
+
+    Смещение отбрасывается: в дни перехода на летнее/зимнее время в одном столбце встречаются
+    +02:00 и +03:00, а рабочее время и так считается по местным часам. Формат у портала фиксированный,
+    поэтому дата разбирается numpy по первым 19 символам - это на порядок быстрее pd.to_datetime
+    с определением формата по каждой строке. Другой формат разбирается pd.Timestamp построчно
+    """
+    try:
+        return pd.Series(np.array([value[:19] if value else 'NaT' for value in values], dtype='datetime64[s]'))
+    except ValueError:
+        return pd.to_datetime(pd.Series(values, dtype=object).map(
+            lambda value: pd.NaT if not value else pd.Timestamp(value).tz_localize(None)))
+
+
+def prepare_leads(leads: list, holidays=None) -> pd.DataFrame:
+    """
+    Лиды из СRM -> типизированный DataFrame с датами по местному времени и РАБОЧИМ временем реакции (исключая ночные часы 21:00-09:00)
+
+    ID - int64, ASSIGNED_BY_ID, STATUS_ID и UTM_SOURCE - категории, даты разбираются сразу при построении колонок
+    """
+    columns = _columns(leads, LEAD_SELECT)
+    leads_df = pd.DataFrame({
+        'ID': _id_column(columns['ID']).astype('int64'),
+        'STATUS_ID': pd.Categorical(columns['STATUS_ID']),
+        'ASSIGNED_BY_ID': _id_column(columns['ASSIGNED_BY_ID']).astype('category'),
+        'DATE_CREATE': _datetime_column(columns['DATE_CREATE']),
+        'UTM_SOURCE': pd.Categorical(columns['UTM_SOURCE']),
+        'taken_in_work': _datetime_column(columns['UF_CRM_1745414446']),
+    })
+
+    with METRICS.timer('working_hours'):
+        leads_df['time_taken_in_work'] = calculate_working_hours_vectorized(
+            leads_df['DATE_CREATE'], leads_df['taken_in_work'], holidays=holidays
+        )
+    return leads_df
+
+
+def concat_leads(frames: list) -> pd.DataFrame:
+    """
+    Склеивает результаты prepare_leads за несколько дней
+
+    pd.concat превращает категории с разным набором значений в object, поэтому категории
+    собираются заново; пустые дни пропускаются, у их категорий другой тип
+    """
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    combined = pd.concat(frames, ignore_index=True)
+    for column in LEAD_CATEGORIES:
+        if not isinstance(combined[column].dtype, pd.CategoricalDtype):
+            combined[column] = combined[column].astype(frames[0][column].cat.categories.dtype).astype('category')
+    return combined
+
+
+def prepare_deals(deals: list) -> pd.DataFrame:
+    """Сделки из СRM -> DataFrame с ID и менеджером (Int64) - для отчета нужны только они"""
+    columns = _columns(deals, ['ID', 'ASSIGNED_BY_ID'])
+    return pd.DataFrame({'ID': _id_column(columns['ID']), 'ASSIGNED_BY_ID': _id_column(columns['ASSIGNED_BY_ID'])})
+
+
+def prepare_users(items_users: list) -> pd.DataFrame:
+    users_df = pd.DataFrame(items_users)[['ID', 'NAME', 'LAST_NAME', 'SECOND_NAME']]
+    users_df['FULL_NAME'] = users_df[['NAME', 'LAST_NAME', 'SECOND_NAME']].fillna('').agg(' '.join, axis=1).str.strip()
+    users_df['ID'] = _id_column(users_df['ID'])
+    return users_df[['ID', 'FULL_NAME']]
+
+
+def prepare_statuses(status_list: list) -> pd.DataFrame:
+    df_status = pd.DataFrame(status_list)
+    return df_status[['STATUS_ID', 'NAME']]
+
+
+def aggregate_report(leads_df: pd.DataFrame, deals_df: pd.DataFrame, users_df: pd.DataFrame):
+    """
+    Конверсия из лида в продажу и время реакции по менеджерам и по отделу
+
+    ДЛЯ МЕНЕДЖЕРОВ медиана считается без обрезки, ДЛЯ ОТДЕЛА - с обрезкой выбросов 1%-95%.
+    Количество лидов и медиана по менеджерам считаются за один проход groupby, сделки -
+    одним value_counts, квантили и медиана отдела - по тому же массиву времени реакции.
+
+    Returns:
+        (full_agg_data, median_reaction) - DataFrame с колонками CR%, FULL_NAME, time_taken_in_work
+        и медиана времени реакции по отделу (timedelta или NaT)
+    """
+    reaction = leads_df['time_taken_in_work']
+    has_time = reaction.notna()
+
+    agg = leads_df.groupby('ASSIGNED_BY_ID', observed=True).agg(
+        number_of_leads=('ID', 'count'),
+        time_taken_in_work=('time_taken_in_work', 'median'),
+    )
+    agg['number_of_deals'] = deals_df['ASSIGNED_BY_ID'].value_counts().reindex(agg.index, fill_value=0)
+    # Менеджер без взятых в работу лидов получает 0, а если таких лидов нет вовсе - N/A
+    if has_time.any():
+        agg['time_taken_in_work'] = agg['time_taken_in_work'].fillna(pd.Timedelta(0))
+    agg['CR%'] = round(agg.number_of_deals / agg.number_of_leads * 100, 2)
+
+    full_agg_data = agg.reset_index().merge(users_df, left_on='ASSIGNED_BY_ID', right_on='ID')
+
+    # Обрезка выбросов ДЛЯ ОТДЕЛА (1%-95%)
+    median_reaction = pd.NaT
+    if has_time.any():
+        seconds = reaction[has_time].dt.total_seconds().to_numpy()
+        lower_bound, upper_bound = np.quantile(seconds, [0.01, 0.95])
+        trimmed = (seconds >= lower_bound) & (seconds <= upper_bound)
+        median_reaction = reaction[has_time][trimmed].median()
+    return full_agg_data[['CR%', 'FULL_NAME', 'time_taken_in_work']], median_reaction
+
+
+def join_leads(leads_df: pd.DataFrame, users_df: pd.DataFrame, df_status: pd.DataFrame) -> pd.DataFrame:
+    """Лиды с именами менеджеров и названиями стадий: ID_lead, DATE_CREATE, UTM_SOURCE, manager_name, status_lead"""
+    leads_by_managers = leads_df.merge(users_df,how='inner', left_on='ASSIGNED_BY_ID', right_on='ID')
+    full_data = leads_by_managers.merge(df_status,how='inner', left_on='STATUS_ID', right_on='STATUS_ID') \
+        .drop_duplicates()[['ID_x','DATE_CREATE','UTM_SOURCE','FULL_NAME','NAME']]
+    full_data = full_data.rename(columns={'ID_x':'ID_lead','FULL_NAME':'manager_name','NAME':'status_lead'})
+    # Категории без лидов (после inner join) не должны попадать в value_counts графиков
+    if isinstance(full_data['UTM_SOURCE'].dtype, pd.CategoricalDtype):
+        full_data['UTM_SOURCE'] = full_data['UTM_SOURCE'].cat.remove_unused_categories()
+    return full_data
+
+
+# Функция для форматирования времени без микросекунд
+def format_time_no_microseconds(td):
+    """Форматирует timedelta без микросекунд (только до секунд)"""
+    if pd.isna(td):
+        return "N/A"
+    total_seconds = int(td.total_seconds())
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def build_message(report_date: str, number_of_leads: int, median_reaction, full_agg_data: pd.DataFrame) -> str:
+    """Текст сводки для Telegram (HTML)"""
+    # Медиана времени по отделу (по обрезанным данным для отдела)
+    median_reaction_str = format_time_no_microseconds(median_reaction)
+    median_reaction_seconds = 0 if pd.isna(median_reaction) else pd.to_timedelta(median_reaction).total_seconds()
+
+    return (
+        f"☀️ Доброе утро!\n"
+        f"📊 Это отчет за <b>{report_date}</b>.\n"
+        f"🚀 Вчера прилетело <b>{number_of_leads}</b> лидов.\n\n"
+        f"🏢 <b>Швидкість реакції по відділу:</b> <b>{median_reaction_str}</b> "
+        f"{'⏰' if median_reaction_seconds > REACTION_ALERT_SECONDS else ''}\n\n"
+        f"<b>Конверсии с лида в продажу и время реакции:</b>\n\n" +
+        "\n────────────\n".join(
+            f"👤 <b>{row['FULL_NAME']}</b>\n"
+            f"   CR%: <b>{row['CR%']:.2f}%</b> {'🔴' if row['CR%'] < 0.1 else ''}\n"
+            f"   Швидкість реакції: <b>{format_time_no_microseconds(row['time_taken_in_work'])}</b> "
+            f"{'⏰' if pd.notna(row['time_taken_in_work']) and pd.to_timedelta(row['time_taken_in_work']).total_seconds() > REACTION_ALERT_SECONDS else ''}"
+            for _, row in full_agg_data.iterrows()
+        )
+    )
@@ -0,0 +1,279 @@
+"""
+Несколько отчетов по лидам в одном процессе: разные порталы, воронки, отделы и получатели
+
+Отчеты описываются в JSON файле (пример - reports.example.json):
+    portals  - порталы: domain, user_id, токены, crm_url, лимит запросов (rate, burst)
+    defaults - общие настройки всех отчетов (поля ReportConfig: telegram_token, holidays, cache_dir, ...)
+               и stages по умолчанию
+    reports  - отчеты: name, portal, stages и любые поля ReportConfig (category_id, chat_ids,
+               extra_lead_filter, extra_deal_filter, ...)
+В строках можно ссылаться на переменные окружения: "$B24_TOKEN_LEADS".
+
+На каждый портал - одна сессия aiohttp и один лимитер на все его токены, справочники менеджеров
+и стадий выгружаются один раз на портал, а одинаковые выгрузки лидов и сделок (отчеты одной
+воронки для разных получателей) - один раз на все такие отчеты. Отчеты считаются и отправляются
+параллельно через общий TelegramSender, поэтому лимиты бота тоже общие.
+
+Пример:
+    python scheduler.py reports.json
+    python scheduler.py reports.json --date 2025-01-31 --only sales,support --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import traceback
+from collections import defaultdict
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timedelta
+
+from metrics import METRICS
+from pipeline import (STAGES, ReportConfig, ReportState, fetch_crm_data, fetch_references, read_store, report_filters,
+                      resolve_stages, run_stages, sync_store)
+
+# Настройки портала, которые не относятся к ReportConfig
+PORTAL_OPTIONS = ('rate', 'burst', 'pool_size')
+CONFIG_FIELDS = {f.name for f in fields(ReportConfig)}
+
+
+@dataclass
+class ReportDefinition:
+    """Один отчет из файла расписания"""
+    name: str
+    portal: str
+    config: ReportConfig
+    stages: list = field(default_factory=lambda: list(STAGES))
+
+
+def _expand(value):
+    """Подставляет переменные окружения ($NAME) во все строки настроек"""
+    if isinstance(value, str):
+        return os.path.expandvars(value)
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _expand(item) for key, item in value.items()}
+    return value
+
+
+def load_schedule(path: str, report_date: str = None, only: list = None):
+    """
+    Читает файл расписания
+
+    Returns:
+        (portals, definitions) - настройки порталов по имени и список ReportDefinition
+    """
+    with open(path, encoding='utf-8') as f:
+        schedule = _expand(json.load(f))
+
+    portals = schedule.get('portals') or {}
+    defaults = schedule.get('defaults') or {}
+    report_date = report_date or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    definitions = []
+    for report in schedule.get('reports') or []:
+        name = report['name']
+        if only and name not in only:
+            continue
+        if report.get('portal') not in portals:
+            raise ValueError(f'Отчет {name}: неизвестный портал {report.get("portal")}')
+        portal = portals[report['portal']]
+
+        settings = {**{key: value for key, value in defaults.items() if key != 'stages'},
+                    **{key: value for key, value in portal.items() if key not in PORTAL_OPTIONS},
+                    **{key: value for key, value in report.items() if key not in ('name', 'portal', 'stages')}}
+        unknown = set(settings) - CONFIG_FIELDS
+        if unknown:
+            raise ValueError(f'Отчет {name}: неизвестные настройки {", ".join(sorted(unknown))}')
+        settings['user_id'] = int(settings['user_id'])
+        settings.setdefault('report_date', report_date)
+        stages = report.get('stages') or defaults.get('stages') or list(STAGES)
+        definitions.append(ReportDefinition(name, report['portal'], ReportConfig(**settings), resolve_stages(stages)))
+
+    if only:
+        missing = set(only) - {definition.name for definition in definitions}
+        if missing:
+            raise ValueError(f'В расписании нет отчетов: {", ".join(sorted(missing))}')
+    return portals, definitions
+
+
+def _fetch_key(definition: ReportDefinition) -> str:
+    """Отчеты с одинаковым ключом используют одну выгрузку лидов и сделок"""
+    config = definition.config
+    return json.dumps([definition.portal, config.store_path, report_filters(config)], sort_keys=True, default=str)
+
+
+class PortalClients:
+    """Общие для всех отчетов портала сессия, лимитер и клиенты по токенам"""
+
+    def __init__(self, session, limiter):
+        self.session = session
+        self.limiter = limiter
+        self._clients = {}
+
+    def client(self, config: ReportConfig, token: str):
+        from b24_async import AsyncB24
+
+        if token not in self._clients:
+            self._clients[token] = AsyncB24(config.domain, config.user_id, token, session=self.session,
+                                            limiter=self.limiter, base_url=config.b24_base_url)
+        return self._clients[token]
+
+
+async def fetch_reports(definitions: list, portals: dict) -> dict:
+    """
+    Выгружает данные всех отчетов, у которых есть стадия fetch
+
+    Returns:
+        dict - имя отчета -> (leads, deals, items_users, status_list) или исключение, если выгрузка не удалась
+    """
+    from b24_async import make_async_session
+    from rate_limiter import RateLimiter
+    from reference_cache import ReferenceCache
+
+    definitions = [definition for definition in definitions if 'fetch' in definition.stages]
+    by_portal = defaultdict(list)
+    for definition in definitions:
+        by_portal[definition.portal].append(definition)
+
+    reference_caches = {}
+    results = {}
+
+    async def fetch_portal(portal_name: str, portal_definitions: list):
+        options = portals[portal_name]
+        limiter = RateLimiter(rate=float(options.get('rate', 2.0)), burst=int(options.get('burst', 50)))
+        async with make_async_session(int(options.get('pool_size', 20))) as session:
+            clients = PortalClients(session, limiter)
+
+            # Хранилище синхронизируем один раз на файл - с полями и окнами всех отчетов, которые из него читают,
+            # дальше отчеты только читают из него
+            synced = {}
+            store_filters = defaultdict(list)
+            for definition in portal_definitions:
+                if definition.config.store_path:
+                    store_filters[definition.config.store_path].append(report_filters(definition.config))
+
+            async def crm_data(definition):
+                config = definition.config
+                if not config.store_path:
+                    return await fetch_crm_data(config, clients.client(config, config.token_leads))
+                if config.store_path not in synced:
+                    synced[config.store_path] = asyncio.ensure_future(
+                        asyncio.to_thread(sync_store, config, limiter, store_filters[config.store_path]))
+                await synced[config.store_path]
+                return await asyncio.to_thread(read_store, config)
+
+            fetches = {}
+            for definition in portal_definitions:
+                key = _fetch_key(definition)
+                if key not in fetches:
+                    fetches[key] = asyncio.ensure_future(crm_data(definition))
+            crm_results = dict(zip(fetches, await asyncio.gather(*fetches.values(), return_exceptions=True)))
+
+            # Справочники - один раз на портал, с ID менеджеров и стадий из лидов всех его отчетов
+            first = portal_definitions[0].config
+            cache = reference_caches.setdefault(first.cache_dir, ReferenceCache(first.cache_dir))
+            all_leads = [lead for result in crm_results.values() if not isinstance(result, BaseException)
+                         for lead in result[0]]
+            try:
+                items_users, status_list = await fetch_references(
+                    cache, clients.client(first, first.token_users), clients.client(first, first.token_status),
+                    all_leads, refresh=any(definition.config.cache_refresh for definition in portal_definitions))
+            except Exception as error:
+                items_users = status_list = error
+
+            for definition in portal_definitions:
+                crm_result = crm_results[_fetch_key(definition)]
+                failed = next((result for result in (crm_result, items_users)
+                               if isinstance(result, BaseException)), None)
+                results[definition.name] = failed or (*crm_result, items_users, status_list)
+
+    await asyncio.gather(*(fetch_portal(name, portal_definitions) for name, portal_definitions in by_portal.items()))
+    return results
+
+
+def run_schedule(definitions: list, portals: dict, workers: int = 4) -> dict:
+    """
+    Выполняет все отчеты: сначала общая выгрузка, потом остальные стадии, до workers отчетов одновременно
+
+    Returns:
+        dict - имя отчета -> ReportState или исключение, если отчет не удался
+    """
+    from telegram_delivery import TELEGRAM_API, TelegramSender
+
+    with METRICS.timer('schedule:fetch'):
+        fetched = asyncio.run(fetch_reports(definitions, portals))
+
+    senders = {}
+    states = {}
+    for definition in definitions:
+        config = definition.config
+        state = ReportState(config=config)
+        if 'deliver' in definition.stages:
+            sender_key = (config.telegram_token, config.telegram_api_url)
+            if sender_key not in senders:
+                senders[sender_key] = TelegramSender(config.telegram_token,
+                                                     api_url=config.telegram_api_url or TELEGRAM_API)
+            state.telegram = senders[sender_key]
+        if definition.name in fetched:
+            data = fetched[definition.name]
+            if isinstance(data, BaseException):
+                states[definition.name] = data
+                continue
+            state.leads, state.deals, state.items_users, state.status_list = data
+            for dataset in ('leads', 'deals', 'items_users', 'status_list'):
+                METRICS.add_rows(f'{definition.name}:fetch:{dataset}', len(getattr(state, dataset)))
+        states[definition.name] = state
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(workers)
+
+        async def run_one(definition):
+            state = states[definition.name]
+            if isinstance(state, BaseException):
+                return state
+            stages = [stage for stage in definition.stages if stage != 'fetch']
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(run_stages, state, stages, definition.name)
+                except Exception as error:
+                    return error
+
+        return await asyncio.gather(*(run_one(definition) for definition in definitions))
+
+    return dict(zip((definition.name for definition in definitions), asyncio.run(run_all())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Несколько отчетов по лидам по расписанию из JSON файла')
+    parser.add_argument('schedule', help='JSON файл с порталами и отчетами')
+    parser.add_argument('--date', help='отчетный день YYYY-MM-DD для всех отчетов (по умолчанию вчера)')
+    parser.add_argument('--only', help='имена отчетов через запятую')
+    parser.add_argument('--workers', type=int, default=4, help='сколько отчетов считать одновременно')
+    parser.add_argument('--metrics-path', help='сохранить метрики запуска в JSON')
+    parser.add_argument('--prometheus-path', help='сохранить метрики запуска в формате Prometheus')
+    args = parser.parse_args(argv)
+
+    only = [name.strip() for name in args.only.split(',') if name.strip()] if args.only else None
+    portals, definitions = load_schedule(args.schedule, report_date=args.date, only=only)
+
+    METRICS.reset()
+    try:
+        results = run_schedule(definitions, portals, workers=args.workers)
+    finally:
+        METRICS.emit(args.metrics_path, args.prometheus_path)
+
+    failed = 0
+    for name, result in results.items():
+        if isinstance(result, BaseException):
+            failed += 1
+            print(f'[Ошибка] Отчет {name}:', ''.join(traceback.format_exception(type(result), result, result.__traceback__)).strip())
+        else:
+            print(f'Отчет {name}: готов')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
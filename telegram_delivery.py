@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from b24 import make_session
+from metrics import METRICS, body_size
+from rate_limiter import RateLimiter, backoff_delay
+
+TELEGRAM_API = 'https://api.telegram.org'
+
+# Лимиты Bot API: не больше ~1 сообщения в секунду в один чат и ~30 сообщений в секунду всего
+CHAT_RATE = 1.0
+GLOBAL_RATE = 30.0
+
+
+class TelegramSender:
+    """
+    Рассылка отчета в Telegram по списку чатов
+
+    Файл (график, Excel) загружается один раз - в первый чат, остальным чатам
+    отправляется уже полученный file_id, поэтому объем загрузки не растет с числом получателей.
+    Отправка по чатам идет параллельно через общую keep-alive сессию, с лимитом на чат
+    и общим лимитом бота; на 429 ждем retry_after из ответа Telegram и повторяем.
+
+    Args:
+        token: str - токен бота
+        max_workers: int - сколько чатов обслуживаются одновременно
+    """
+
+    def __init__(self, token: str, session=None, max_workers: int = 8, api_url: str = TELEGRAM_API,
+                 max_retries: int = 5):
+        self.token = token
+        self.session = session or make_session()
+        self.max_workers = max_workers
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self.global_limiter = RateLimiter(rate=GLOBAL_RATE, burst=int(GLOBAL_RATE))
+        self._chat_limiters = {}
+        self._lock = threading.Lock()
+
+    def _chat_limiter(self, chat_id) -> RateLimiter:
+        with self._lock:
+            if chat_id not in self._chat_limiters:
+                self._chat_limiters[chat_id] = RateLimiter(rate=CHAT_RATE, burst=1)
+            return self._chat_limiters[chat_id]
+
+    def _call(self, method: str, chat_id, data: dict, files: dict = None) -> dict:
+        """Вызов метода Bot API для одного чата с соблюдением лимитов и повтором на 429/5xx"""
+        url = f'{self.api_url}/bot{self.token}/{method}'
+        chat_limiter = self._chat_limiter(chat_id)
+        for attempt in range(self.max_retries + 1):
+            METRICS.record_throttle('telegram', method, chat_limiter.acquire() + self.global_limiter.acquire())
+            started = time.perf_counter()
+            resp = self.session.post(url, data={'chat_id': chat_id, **data}, files=files)
+            METRICS.record_http('telegram', method, resp.status_code, time.perf_counter() - started,
+                                body_size(resp.request.body), len(resp.content))
+            try:
+                payload = resp.json()
+            except ValueError:
+                payload = {'ok': False, 'description': resp.text[:200]}
+
+            if resp.status_code == 429 and attempt < self.max_retries:
+                retry_after = payload.get('parameters', {}).get('retry_after') or backoff_delay(attempt)
+                print(f'[Telegram] {method} chat {chat_id}: 429, retry after {retry_after}s')
+                chat_limiter.penalize(retry_after)
+                continue
+            if resp.status_code >= 500 and attempt < self.max_retries:
+                delay = backoff_delay(attempt)
+                METRICS.record_throttle('telegram', method, delay)
+                time.sleep(delay)
+                continue
+            if not payload.get('ok'):
+                print(f"[Ошибка Telegram] {method} chat {chat_id}: {payload.get('description')}")
+            return payload
+
+    def _send_all(self, method: str, chat_ids: list, data: dict) -> list:
+        """Параллельно отправляет одно и то же data во все чаты"""
+        if not chat_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chat_ids))) as executor:
+            return list(executor.map(lambda chat_id: self._call(method, chat_id, data), chat_ids))
+
+    def send_message(self, text: str, chat_ids: list, parse_mode: str = 'HTML') -> list:
+        return self._send_all('sendMessage', chat_ids, {'text': text, 'parse_mode': parse_mode})
+
+    def _send_file(self, method: str, field: str, content, filename: str, chat_ids: list, get_file_id) -> list:
+        """
+        Загружает файл в первый чат, которому удалось его отправить, и рассылает file_id остальным
+
+        Args:
+            content: bytes или путь к файлу
+            get_file_id: функция result -> file_id из ответа Telegram
+        """
+        if isinstance(content, (str, os.PathLike)):
+            filename = filename or os.path.basename(content)
+            with open(content, 'rb') as f:
+                content = f.read()
+
+        results = []
+        for i, chat_id in enumerate(chat_ids):
+            payload = self._call(method, chat_id, {}, files={field: (filename, content)})
+            results.append(payload)
+            if payload.get('ok'):
+                file_id = get_file_id(payload['result'])
+                return results + self._send_all(method, chat_ids[i + 1:], {field: file_id})
+        return results
+
+    def send_photo(self, photo, chat_ids: list, filename: str = 'report.png') -> list:
+        return self._send_file('sendPhoto', 'photo', photo, filename, chat_ids,
+                               lambda result: result['photo'][-1]['file_id'])
+
+    def send_document(self, document, chat_ids: list, filename: str = None) -> list:
+        return self._send_file('sendDocument', 'document', document, filename, chat_ids,
+                               lambda result: result['document']['file_id'])
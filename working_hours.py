@@ -0,0 +1,173 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+
+# ФУНКЦИЯ ДЛЯ РАСЧЕТА РАБОЧЕГО ВРЕМЕНИ (исключая только ночные часы)
+def calculate_working_hours(start_time, end_time, work_start_hour=9, work_end_hour=21, holidays=None):
+    """
+    Рассчитывает количество рабочих часов между двумя датами,
+    исключая ТОЛЬКО ночные часы (по умолчанию с 21:00 до 09:00)
+    Все дни недели считаются рабочими (включая субботу и воскресенье)
+
+    Args:
+        start_time: datetime - время создания лида
+        end_time: datetime - время взятия в работу
+        work_start_hour: int - начало рабочего дня (по умолчанию 9)
+        work_end_hour: int - конец рабочего дня (по умолчанию 21)
+        holidays: iterable - нерабочие дни (date или строки 'YYYY-MM-DD'), по умолчанию нет
+
+    Returns:
+        timedelta - рабочее время
+    """
+    if pd.isna(start_time) or pd.isna(end_time):
+        return pd.NaT
+
+    holiday_dates = {pd.Timestamp(day).date() for day in holidays} if holidays else set()
+    total_working_seconds = 0
+    current_time = start_time
+
+    while current_time < end_time:
+        current_hour = current_time.hour
+
+        # Праздничный день целиком пропускаем
+        if current_time.date() in holiday_dates:
+            next_day = current_time + timedelta(days=1)
+            current_time = next_day.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+        # Если текущее время в рабочих часах (09:00 - 21:00)
+        elif work_start_hour <= current_hour < work_end_hour:
+            # Находим конец рабочего периода в этот день
+            end_of_work_today = current_time.replace(hour=work_end_hour, minute=0, second=0, microsecond=0)
+
+            # Берем минимум из конца рабочего дня и времени взятия в работу
+            period_end = min(end_of_work_today, end_time)
+
+            # Добавляем рабочие секунды
+            working_seconds = (period_end - current_time).total_seconds()
+            total_working_seconds += working_seconds
+
+            current_time = period_end
+        else:
+            # Если сейчас нерабочее время (ночь), переходим к началу следующего рабочего дня
+            if current_hour < work_start_hour:
+                # Если время до начала рабочего дня (00:00 - 09:00)
+                current_time = current_time.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+            else:
+                # Если время после конца рабочего дня (21:00 - 23:59), переходим к следующему дню
+                next_day = current_time + timedelta(days=1)
+                current_time = next_day.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+
+    return timedelta(seconds=total_working_seconds)
+
+
+def add_working_hours(start_time, duration: timedelta, work_start_hour=9, work_end_hour=21, holidays=None):
+    """
+    Момент, когда с start_time пройдет duration РАБОЧЕГО времени - обратное к calculate_working_hours:
+    calculate_working_hours(start_time, add_working_hours(start_time, duration)) == duration
+
+    Args:
+        start_time: datetime - время создания лида
+        duration: timedelta - сколько рабочего времени должно пройти
+        holidays: iterable - нерабочие дни (date или строки 'YYYY-MM-DD'), по умолчанию нет
+
+    Returns:
+        datetime - в том же часовом поясе, что и start_time
+    """
+    holiday_dates = {pd.Timestamp(day).date() for day in holidays} if holidays else set()
+    remaining_seconds = duration.total_seconds()
+    current_time = start_time
+
+    while True:
+        current_hour = current_time.hour
+
+        if current_time.date() in holiday_dates:
+            next_day = current_time + timedelta(days=1)
+            current_time = next_day.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+        elif work_start_hour <= current_hour < work_end_hour:
+            end_of_work_today = current_time.replace(hour=work_end_hour, minute=0, second=0, microsecond=0)
+            available_seconds = (end_of_work_today - current_time).total_seconds()
+            if remaining_seconds <= available_seconds:
+                return current_time + timedelta(seconds=remaining_seconds)
+            remaining_seconds -= available_seconds
+            current_time = end_of_work_today
+        elif current_hour < work_start_hour:
+            current_time = current_time.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+        else:
+            next_day = current_time + timedelta(days=1)
+            current_time = next_day.replace(hour=work_start_hour, minute=0, second=0, microsecond=0)
+
+
+def _to_wall_clock(values) -> pd.Series:
+    """
+    Приводит значения к naive datetime64[ns] по местному времени (как .hour в calculate_working_hours)
+
+    В дни перехода на летнее/зимнее время в одном столбце встречаются разные смещения (+02:00 и +03:00),
+    такой столбец приходит как object - смещение снимается с каждого значения отдельно
+    """
+    series = pd.Series(values)
+    if series.dtype == object:
+        series = series.map(lambda value: pd.NaT if pd.isna(value) else pd.Timestamp(value).tz_localize(None))
+    series = pd.to_datetime(series)
+    if series.dt.tz is not None:
+        series = series.dt.tz_localize(None)
+    return series.astype('datetime64[ns]')
+
+
+def _working_ns_since_epoch(values: np.ndarray, work_start_hour: int, work_end_hour: int,
+                            holiday_days: np.ndarray) -> np.ndarray:
+    """
+    Рабочее время (в наносекундах) от 1970-01-01 до каждого момента
+
+    Каждый целый день дает (work_end_hour - work_start_hour) часов, текущий день -
+    время с начала рабочего дня, обрезанное по его длине. Праздники дают ноль.
+    Рабочее время между двумя моментами - разность этих значений.
+    """
+    days = values.astype('datetime64[D]')
+    day_numbers = days.astype(np.int64)
+    ns_of_day = (values - days).astype('timedelta64[ns]').astype(np.int64)
+
+    hour_ns = 3600 * 10 ** 9
+    day_length = (work_end_hour - work_start_hour) * hour_ns
+    partial = np.clip(ns_of_day - work_start_hour * hour_ns, 0, day_length)
+
+    if len(holiday_days):
+        holidays_before = np.searchsorted(holiday_days, day_numbers, side='left')
+        is_holiday = holiday_days[np.minimum(holidays_before, len(holiday_days) - 1)] == day_numbers
+        day_numbers = day_numbers - holidays_before
+        partial = np.where(is_holiday, 0, partial)
+
+    return day_numbers * day_length + partial
+
+
+def calculate_working_hours_vectorized(start_times, end_times, work_start_hour=9, work_end_hour=21, holidays=None):
+    """
+    Векторная версия calculate_working_hours для целых колонок
+
+    Вместо цикла по часам для каждой строки считает рабочее время арифметикой над
+    datetime64: целые дни умножаются на длину рабочего дня, первый и последний дни
+    обрезаются по рабочим часам. Результат совпадает с calculate_working_hours
+    при тех же work_start_hour/work_end_hour/holidays, NaT на входе дает NaT.
+
+    Args:
+        start_times: Series - время создания лидов
+        end_times: Series - время взятия в работу
+        work_start_hour: int - начало рабочего дня (по умолчанию 9)
+        work_end_hour: int - конец рабочего дня (по умолчанию 21)
+        holidays: iterable - нерабочие дни (date или строки 'YYYY-MM-DD'), по умолчанию нет
+
+    Returns:
+        Series timedelta64[ns] - рабочее время
+    """
+    index = start_times.index if isinstance(start_times, pd.Series) else None
+    start = _to_wall_clock(start_times)
+    end = _to_wall_clock(end_times)
+    missing = (start.isna() | end.isna()).to_numpy()
+
+    holiday_days = np.unique(pd.to_datetime(list(holidays or [])).values.astype('datetime64[D]').astype(np.int64))
+    start_ns = _working_ns_since_epoch(start.to_numpy(), work_start_hour, work_end_hour, holiday_days)
+    end_ns = _working_ns_since_epoch(end.to_numpy(), work_start_hour, work_end_hour, holiday_days)
+
+    working = np.maximum(end_ns - start_ns, 0).astype('timedelta64[ns]')
+    working[missing] = np.timedelta64('NaT')
+    return pd.Series(working, index=index)